@@ -1,3 +1,54 @@
+from typing import Tuple, Any
+
+import bencodepy
+
+try:
+    from fastbencode import bdecode as _fast_bdecode
+except ImportError:  # optional compiled decoder, bencodepy is pure python
+    _fast_bdecode = None
+
+# token bytes, compared as ints against memoryview items
+_INT = 0x69  # b'i'
+_LIST = 0x6c  # b'l'
+_DICT = 0x64  # b'd'
+_END = 0x65  # b'e'
+_ZERO = 0x30  # b'0'
+_NINE = 0x39  # b'9'
+
+# marks a dict frame that is waiting for its next key
+_NO_KEY = object()
+
+
+def _skip_value(data: bytes, view: memoryview, index: int) -> int:
+    """returns the index just past the bencoded value starting at index, without building it"""
+    data_len = len(data)
+    depth = 0
+
+    while True:
+        if index >= data_len:
+            raise ValueError(f"Invalid bencode at index {index}: unexpected end of data")
+
+        token = view[index]
+
+        if token == _INT:
+            index = data.index(b'e', index) + 1
+        elif _ZERO <= token <= _NINE:
+            colon = data.index(b':', index)
+            index = colon + 1 + int(data[index:colon])
+            if index > data_len:
+                raise ValueError(f"Invalid bencode at index {colon}: string runs past end of data")
+        elif token == _LIST or token == _DICT:
+            depth += 1
+            index += 1
+            continue
+        elif token == _END and depth:
+            depth -= 1
+            index += 1
+        else:
+            raise ValueError(f"Invalid bencode at index {index}: {data[index:index + 10]}")
+
+        if depth == 0:
+            return index
 
 
 class Bencode:
@@ -6,44 +57,118 @@ class Bencode:
     """
     @staticmethod
     def bencode_decode(data: bytes) -> dict:
-        def decode(index: int):
-            if data[index:index + 1] == b'i':
+        view = memoryview(data)
+        data_len = len(data)
+
+        # open containers, each frame is [container, pending dict key]
+        stack = []
+        index = 0
+
+        while True:
+            if index >= data_len:
+                raise ValueError(f"Invalid bencode at index {index}: unexpected end of data")
+
+            token = view[index]
+
+            if token == _INT:
                 end = data.index(b'e', index)
-                number = int(data[index + 1:end])
-                return number, end + 1
+                value = int(data[index + 1:end])
+                index = end + 1
 
-            elif data[index:index + 1].isdigit():
+            elif _ZERO <= token <= _NINE:
                 colon = data.index(b':', index)
                 length = int(data[index:colon])
                 start = colon + 1
                 end = start + length
-                raw = data[start:end]
+                if end > data_len:
+                    raise ValueError(f"Invalid bencode at index {index}: string runs past end of data")
                 try:
-                    return raw.decode('utf-8'), end
+                    value = str(view[start:end], 'utf-8')
                 except UnicodeDecodeError:
-                    return raw, end
+                    value = bytes(view[start:end])
+                index = end
+
+            elif token == _LIST:
+                stack.append([[], _NO_KEY])
+                index += 1
+                continue
 
-            elif data[index:index + 1] == b'l':
+            elif token == _DICT:
+                stack.append([{}, _NO_KEY])
                 index += 1
-                lst = []
-                while data[index:index + 1] != b'e':
-                    item, index = decode(index)
-                    lst.append(item)
-                return lst, index + 1
+                continue
 
-            elif data[index:index + 1] == b'd':
+            elif token == _END and stack:
+                value, key = stack.pop()
+                if key is not _NO_KEY:
+                    raise ValueError(f"Invalid bencode at index {index}: dict key without value")
                 index += 1
-                dct = {}
-                while data[index:index + 1] != b'e':
-                    key, index = decode(index)
-                    value, index = decode(index)
-                    dct[key] = value
-                return dct, index + 1
 
             else:
                 raise ValueError(f"Invalid bencode at index {index}: {data[index:index + 10]}")
 
-        value, final_index = decode(0)
-        if final_index != len(data):
+            # attach the finished value to its parent container
+            if not stack:
+                break
+
+            frame = stack[-1]
+            container = frame[0]
+            if type(container) is list:
+                container.append(value)
+            elif frame[1] is _NO_KEY:
+                frame[1] = value
+            else:
+                container[frame[1]] = value
+                frame[1] = _NO_KEY
+
+        if index != data_len:
             raise ValueError("Extra data after decoding")
         return value
+
+    @staticmethod
+    def decode_raw(data: bytes) -> Any:
+        """
+        decodes bencoded data keeping keys and strings as bytes,
+        uses the compiled fastbencode decoder when it is installed
+
+        Args:
+            data: bencoded bytes
+
+        Returns:
+            the decoded value
+        """
+        if _fast_bdecode is not None:
+            try:
+                return _fast_bdecode(data)
+            except ValueError:
+                pass  # fastbencode rejects non-canonical input (e.g. unsorted keys) that bencodepy accepts
+        return bencodepy.decode(data)
+
+    @staticmethod
+    def find_info_slice(data: bytes) -> Tuple[int, int]:
+        """
+        locates the raw bencoded 'info' dictionary of a .torrent, so it can be
+        hashed as-is instead of being decoded and re-encoded
+
+        Args:
+            data: bencoded .torrent contents
+
+        Returns:
+            (start, end) such that data[start:end] is the encoded info dictionary
+
+        Raises:
+            ValueError: if data is not a dictionary or has no 'info' key
+        """
+        view = memoryview(data)
+        if not data or view[0] != _DICT:
+            raise ValueError("Invalid bencode: top level value is not a dict")
+
+        index = 1
+        while index < len(data) and view[index] != _END:
+            key_end = _skip_value(data, view, index)
+            value_end = _skip_value(data, view, key_end)
+            if data[index:key_end] == b'4:info':
+                return key_end, value_end
+            index = value_end
+
+        raise ValueError("Invalid torrent: missing info dictionary")
@@ -12,9 +12,12 @@ class Block:
         length: length of this block in bytes
         is_requested: True if this block has been requested
         is_received: True if this block has been received
-        request_time: timestamp of when this block was requested
+        request_time: time.monotonic() timestamp of when this block was requested
     """
 
+    # one Block exists per 16 KiB of torrent, so skip the per-instance __dict__
+    __slots__ = ("piece_index", "offset", "length", "is_requested", "is_received", "request_time")
+
     def __init__(self, piece_index: int, offset: int, length: int):
         """
         initializes the Block
@@ -29,12 +32,12 @@ class Block:
         self.length: int = length
         self.is_requested: bool = False
         self.is_received: bool = False
-        self.request_time: Optional[bool] = None
+        self.request_time: Optional[float] = None
 
     def set_requested(self):
         """marks as requested, sets timestamp"""
         self.is_requested = True
-        self.request_time = time.time()
+        self.request_time = time.monotonic()
 
     def reset(self):
         """resets block state"""
@@ -1,24 +1,44 @@
+import asyncio
 import hashlib
 import json
 import os
+import shutil
+import string
 import threading
 import time
-from datetime import datetime
-from typing import List, Any, Dict, cast, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, Dict, cast, Optional, BinaryIO, Tuple
 
-import bencodepy
 from fastapi import FastAPI
 from fastapi import Form
 from fastapi import UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from .torrent_client import TorrentClient
+from .bencode import Bencode
+from .hashing import sha1_digest
+from .torrent_client import TorrentClient, format_timestamp
+
+try:
+    import orjson
+except ImportError:  # optional, fall back to stdlib json
+    orjson = None
 
 SESSION_FILE = "./session.json"
+SAVE_DEBOUNCE = 1.0  # seconds to coalesce session saves
+PARSE_CACHE_SIZE = 128
+UPLOAD_CHUNK_SIZE = 1 << 16
 
 app = FastAPI()
 torrents: List[TorrentClient] = []  # TorrentClient instances
+_reannounce_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="reannounce")
+# (key, response) of the last rendered /status, swapped as one tuple so overlapping polls on
+# the threadpool never pair a new key with an older response
+_status_cache: Tuple[Optional[tuple], Optional[Dict[str, Any]]] = (None, None)
+_save_lock = threading.Lock()  # serializes session file writes
+_save_pending = threading.Event()  # set when a session save is requested
+_parse_cache: "OrderedDict[bytes, dict[str, Any]]" = OrderedDict()  # content digest -> /parse result
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,58 +49,97 @@ app.add_middleware(
 )
 
 
+# azureus style client codes
+_CLIENT_MAP = {
+    "qB": "qBittorrent",
+    "UT": "uTorrent",
+    "TR": "Transmission",
+    "DE": "Deluge",
+    "LT": "libtorrent",
+    "AZ": "Azureus",
+    "BW": "BitComet",
+    "UW": "uTorrent Web",
+    "lt": "libTorrent",
+}
+
+# version characters that are letters encode base 36 digits, e.g. 'A' -> '10'
+_VERSION_DIGITS = {c: str(int(c, 36)) for c in string.ascii_letters}
+
+
 def parse_peer_id(peer_id: str) -> str:
     # azureus style
-    if len(peer_id) < 8 or peer_id[0] != '-':
+    if len(peer_id) < 8 or not peer_id.startswith('-'):
         return peer_id
 
-    code = peer_id[1:3]
-    version = peer_id[3:7]
-
-    client_map = {
-        "qB": "qBittorrent",
-        "UT": "uTorrent",
-        "TR": "Transmission",
-        "DE": "Deluge",
-        "LT": "libtorrent",
-        "AZ": "Azureus",
-        "BW": "BitComet",
-        "UW": "uTorrent Web",
-        "lt": "libTorrent",
-    }
+    name = _CLIENT_MAP.get(peer_id[1:3])
+    if name is None:
+        return peer_id
 
-    name = client_map.get(code, "Unknown")
-    if name != "Unknown":
-        version_str = '.'.join(str(int(c, 36)) if c.isalpha() else c for c in version)
-        return f"{name} {version_str}"
-    return peer_id
+    version_str = '.'.join([_VERSION_DIGITS.get(c, c) for c in peer_id[3:7]])
+    return f"{name} {version_str}"
 
 
-def save_session() -> None:
-    """saves current torrent session states to disk"""
-    data = []
-    for torrent in torrents:
-        data.append({
-            "torrent_path": torrent.torrent_file.path,
-            "download_dir": torrent.download_dir,
-            "paused": getattr(torrent, "paused", False),
-            "is_finished": torrent.piece_manager.is_finished(),
-            "added_on": torrent.added_on,
-            "completed_on": torrent.completed_on
-        })
-    with open(SESSION_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+def _dumps_session(data: list) -> bytes:
+    """serializes session entries to indented json bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode()
+
+
+def _loads_session(raw: bytes) -> list:
+    """parses session json bytes"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _write_session() -> None:
+    """writes current torrent session states to disk, replacing the file atomically"""
+    with _save_lock:
+        data = []
+        for torrent in list(torrents):
+            data.append({
+                "torrent_path": torrent.torrent_file.path,
+                "download_dir": torrent.download_dir,
+                "paused": getattr(torrent, "paused", False),
+                "is_finished": torrent.piece_manager.is_finished(),
+                "added_on": torrent.added_on,
+                "completed_on": torrent.completed_on
+            })
+
+        tmp_path = SESSION_FILE + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_dumps_session(data))
+        os.replace(tmp_path, SESSION_FILE)
+
     print(f"[session] Saved {len(data)} torrents to session.json")
 
 
+def _session_writer() -> None:
+    """background thread, coalesces save requests into one write per SAVE_DEBOUNCE window"""
+    while True:
+        _save_pending.wait()
+        time.sleep(SAVE_DEBOUNCE)
+        _save_pending.clear()
+        try:
+            _write_session()
+        except Exception as e:
+            print(f"[session] Failed to save session: {e}")
+
+
+def save_session() -> None:
+    """schedules a save of the current torrent session states"""
+    _save_pending.set()
+
+
 def load_session() -> None:
     """loads torrent session state from disk"""
     if not os.path.exists(SESSION_FILE):
         print("[session] No session file found, skipping")
         return
 
-    with open(SESSION_FILE, "r") as f:
-        data = json.load(f)
+    with open(SESSION_FILE, "rb") as f:
+        data = _loads_session(f.read())
 
     print(f"[session] Loading {len(data)} torrents from session file")
     for entry in data:
@@ -128,14 +187,18 @@ def force_reannounce(req: ReannounceRequest):
         raise HTTPException(404, f"torrent id {req.id} not found")
 
     for torrent in targets:
-        # call the helper you added in step-3 earlier
-        threading.Thread(
-            target=lambda: torrent.announce_now(event=""), daemon=True
-        ).start()
+        _reannounce_pool.submit(torrent.announce_now, event="")
 
     return {"status": "ok", "count": len(targets)}
 
 
+def _save_upload(src: BinaryIO, download_dir: str, save_path: str) -> None:
+    """streams an uploaded file to disk in UPLOAD_CHUNK_SIZE chunks"""
+    os.makedirs(download_dir, exist_ok=True)
+    with open(save_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+
+
 @app.post("/upload")
 async def upload_torrent(file: UploadFile = File(...), downloadPath: str = Form(...)):
     """
@@ -145,14 +208,11 @@ async def upload_torrent(file: UploadFile = File(...), downloadPath: str = Form(
         file: bytes of .torrent file
         downloadPath: directory where files should be saved
     """
-    os.makedirs(downloadPath, exist_ok=True)
     save_path = os.path.join(downloadPath, file.filename)
 
-    contents = await file.read()
-    with open(save_path, "wb") as f:
-        f.write(contents)
-
-    client = TorrentClient(save_path, download_dir=downloadPath)
+    # disk writes and torrent parsing / verification run off the event loop
+    await asyncio.to_thread(_save_upload, file.file, downloadPath, save_path)
+    client = await asyncio.to_thread(TorrentClient, save_path, download_dir=downloadPath)
     client.start_time = time.time()  # Start tracking download time
     client.added_on = time.time()
     threading.Thread(target=client.download, daemon=True).start()
@@ -163,19 +223,9 @@ async def upload_torrent(file: UploadFile = File(...), downloadPath: str = Form(
     return {"status": "started", "torrent": file.filename}
 
 
-@app.post("/parse")
-async def parse_torrent(file: UploadFile = File(...)) -> dict[str, Any]:
-    """
-    parses a .torrent file and return the metadata
-
-    Args:
-        file: bytes of .torrent file
-
-    Returns:
-        dictionary containing torrent metadata
-    """
-    contents = await file.read()
-    metadata = cast(Dict[bytes, Any], bencodepy.decode(contents))
+def _build_parse_result(contents: bytes) -> dict[str, Any]:
+    """decodes .torrent contents into the metadata summary returned by /parse"""
+    metadata = cast(Dict[bytes, Any], Bencode.decode_raw(contents))
 
     info = metadata[b'info']
 
@@ -205,12 +255,13 @@ async def parse_torrent(file: UploadFile = File(...)) -> dict[str, Any]:
                                                          errors='ignore') if b'created by' in metadata else None
     creation_date = metadata.get(b'creation date', None)
     if isinstance(creation_date, (int, float)):
-        creation_date = datetime.fromtimestamp(creation_date).strftime('%Y-%m-%d %H:%M:%S %Z')
+        creation_date = format_timestamp(creation_date)
     else:
         creation_date = None
 
-    info_bencoded = bencodepy.encode(info)
-    info_hash = hashlib.sha1(info_bencoded).hexdigest()
+    # hash the raw info slice rather than re-encoding the decoded dict
+    info_start, info_end = Bencode.find_info_slice(contents)
+    info_hash = sha1_digest(memoryview(contents)[info_start:info_end]).hex()
 
     return {
         "name": name,
@@ -224,10 +275,43 @@ async def parse_torrent(file: UploadFile = File(...)) -> dict[str, Any]:
     }
 
 
+def _parse_metadata(contents: bytes) -> dict[str, Any]:
+    """
+    memoized _build_parse_result, keyed on a short digest of the contents so
+    re-uploading the same .torrent skips decoding and re-hashing
+    """
+    key = hashlib.blake2b(contents, digest_size=16).digest()
+
+    result = _parse_cache.get(key)
+    if result is not None:
+        _parse_cache.move_to_end(key)
+        return result
+
+    result = _build_parse_result(contents)
+    _parse_cache[key] = result
+    if len(_parse_cache) > PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)  # evict least recently used
+
+    return result
+
+
+@app.post("/parse")
+async def parse_torrent(file: UploadFile = File(...)) -> dict[str, Any]:
+    """
+    parses a .torrent file and return the metadata
+
+    Args:
+        file: bytes of .torrent file
+
+    Returns:
+        dictionary containing torrent metadata
+    """
+    contents = await file.read()
+    return _parse_metadata(contents)
+
+
 def get_progress(peer, num_pieces):
-    if not peer.bitmap:
-        return 0.0
-    return round(100 * peer.bitmap.count(1) / num_pieces, 2)
+    return round(100 * peer.have_count / num_pieces, 2)
 
 
 @app.get("/status")
@@ -238,23 +322,65 @@ def get_status():
     Returns:
         list of dictionaries providing statuses on each torrent
     """
+    global _status_cache
+
     if not torrents:
         return {"torrents": []}  # No torrents yet, return empty list
 
+    now = time.time()
+
+    # speeds and countdowns are per second, everything else only changes with a version bump
+    key = (int(now),) + tuple(torrent.status_version() for torrent in torrents)
+    cached_key, cached_response = _status_cache
+    if key == cached_key:
+        return cached_response
+
     torrent_infos = []
 
     for idx, torrent in enumerate(torrents):
+        num_pieces = torrent.num_pieces
         total_size = torrent.torrent_file.total_length
         done_size = torrent.piece_manager.downloaded_bytes
         percent_done = min((done_size / total_size) * 100 if total_size > 0 else 0, 100)
 
-        if torrent.peer_manager and torrent.peer_manager.peers:
-            speed_mbps = sum(p.down_speed_bps() for p in torrent.peer_manager.peers if p.active) * 8 / 1_000_000
-        else:
-            speed_mbps = 0.0
+        # one pass over the peers: each speed is computed once and reused for
+        # the torrent totals, the seed / peer counts and the peer rows.
+        # paused torrents report no speed or peers, so skip the pass entirely
+        down_bps_total = 0.0
+        num_seeds = num_peers = 0
+        transmitting_seeds = transmitting_peers = 0
+        peer_rows = []
+
+        if torrent.peer_manager and not torrent.paused:
+            for peer in torrent.peer_manager.peers:
+                down_bps = peer.down_speed_bps()
+                up_bps = peer.up_speed_bps()
+
+                if peer.active:
+                    down_bps_total += down_bps
+                    if peer.have_count == num_pieces:
+                        num_seeds += 1
+                        transmitting_seeds += not peer.choked
+                    else:
+                        num_peers += 1
+                        transmitting_peers += not peer.choked
+
+                peer_rows.append({
+                    "ip": peer.ip,
+                    "port": peer.port,
+                    "client": parse_peer_id(peer.remote_id.decode(errors='ignore') if peer.remote_id else ""),
+                    "progress": get_progress(peer, num_pieces),
+                    "flags": ("S" if peer.choked is False else "") + ("I" if peer.interested else ""),
+                    "downSpeed": round(down_bps / 1024, 2),
+                    "upSpeed": round(up_bps / 1024, 2),
+                    "downloaded": peer.total_downloaded,
+                    "uploaded": peer.total_uploaded
+                })
+
+        speed_mbps = down_bps_total * 8 / 1_000_000
 
         if speed_mbps > 0 and percent_done < 100:
-            left_bytes = torrent.torrent_file.total_length * (1 - percent_done / 100)
+            left_bytes = total_size * (1 - percent_done / 100)
             eta_seconds = (left_bytes * 8) / (speed_mbps * 1_000_000)
             eta = time.strftime('%Hh %Mm %Ss', time.gmtime(eta_seconds))
         else:
@@ -265,22 +391,6 @@ def get_status():
 
         is_multi = hasattr(torrent.torrent_file, 'files') and len(torrent.torrent_file.files) > 1
 
-        active_peers = []
-        if torrent.peer_manager:
-            active_peers = [peer for peer in torrent.peer_manager.peers if peer.active]
-
-        seeds = []
-        peers = []
-
-        for peer in active_peers:
-            if peer.bitmap and peer.bitmap.count(1) == torrent.num_pieces:
-                seeds.append(peer)
-            else:
-                peers.append(peer)
-
-        transmitting_seeds = sum(1 for peer in seeds if not peer.choked)
-        transmitting_peers = sum(1 for peer in peers if not peer.choked)
-
         is_complete = torrent.piece_manager.is_finished()
 
         if is_complete:
@@ -294,32 +404,22 @@ def get_status():
         if torrent.paused:
             status = "paused"
 
-        min_next_announce = None
-        for tracker in torrent.tracker_manager.trackers:
-            if hasattr(tracker, 'next_announce'):
-                if min_next_announce is None or tracker.next_announce < min_next_announce:
-                    min_next_announce = tracker.next_announce
+        min_next_announce = torrent.tracker_manager.min_next_announce
 
         if min_next_announce:
-            reannounce_in = max(0, int(min_next_announce - time.time()))
+            reannounce_in = max(0, int(min_next_announce - now))
         else:
             reannounce_in = None
 
         general = {
-            "Total Size": f"{torrent.torrent_file.total_length / 1_000_000:.1f} MB",
-            "Pieces": f"{torrent.num_pieces} × {torrent.torrent_file.piece_length // 1024} KiB",
-            "Added On": datetime.fromtimestamp(torrent.added_on).strftime(
-                '%Y-%m-%d %H:%M:%S %Z') if torrent.added_on else None,
-            "Completed On": datetime.fromtimestamp(torrent.completed_on).strftime(
-                '%Y-%m-%d %H:%M:%S %Z') if torrent.completed_on else None,
-            "Created On": (
-                datetime.fromtimestamp(torrent.torrent_file.metadata.get('creation date')).strftime(
-                    '%Y-%m-%d %H:%M:%S %Z'))
-            if torrent.torrent_file.metadata.get("creation date") else None,
+            "Total Size": f"{total_size / 1_000_000:.1f} MB",
+            "Pieces": f"{num_pieces} × {torrent.torrent_file.piece_length // 1024} KiB",
+            "Added On": torrent.added_on_str,
+            "Completed On": torrent.completed_on_str,
+            "Created On": format_timestamp(torrent.torrent_file.creation_date),
             "Hash": torrent.torrent_file.info_hash.hex(),
             "Saved at": torrent.download_dir,
-            "Comment": torrent.torrent_file.metadata.get(b'comment', b'')
-            .decode('utf-8', errors='ignore') if b'comment' in torrent.torrent_file.metadata else None
+            "Comment": torrent.torrent_file.comment
         }
 
         tracker_rows = [{
@@ -329,35 +429,20 @@ def get_status():
             "peers": tracker.last_peers,
             "seeds": tracker.last_seeds,
             "message": tracker.last_msg,
-            "nextAnnounce": int(tracker.next_announce - time.time())
+            "nextAnnounce": int(tracker.next_announce - now)
         } for i, tracker in enumerate(torrent.tracker_manager.trackers)]
 
-        peer_rows = []
-        if torrent.peer_manager:
-            for peer in torrent.peer_manager.peers:
-                peer_rows.append({
-                    "ip": peer.ip,
-                    "port": peer.port,
-                    "client": parse_peer_id(peer.remote_id.decode(errors='ignore') if peer.remote_id else ""),
-                    "progress": get_progress(peer, torrent.num_pieces),
-                    "flags": ("S" if peer.choked is False else "") + ("I" if peer.interested else ""),
-                    "downSpeed": round(peer.down_speed_bps() / 1024, 2),
-                    "upSpeed": round(peer.up_speed_bps() / 1024, 2),
-                    "downloaded": peer.total_downloaded,
-                    "uploaded": peer.total_uploaded
-                })
-
         torrent_infos.append({
             "id": idx,
             "name": torrent.torrent_file.name,
-            "size": f"{torrent.torrent_file.total_length / 1_000_000:.1f} MB",
+            "size": f"{total_size / 1_000_000:.1f} MB",
             "progress": round(percent_done, 2),
             "status": status,
             "speed": "0 B/s" if torrent.paused else f"{speed_mbps:.2f} Mbps",
             "transmitting_peers": transmitting_peers,
             "transmitting_seeds": transmitting_seeds,
-            "peers": len(peers),
-            "seeds": len(seeds),
+            "peers": num_peers,
+            "seeds": num_seeds,
             "eta": "∞" if torrent.paused else eta,
             "infoHash": torrent.torrent_file.info_hash.hex(),
             "downloadPath": torrent.download_dir,
@@ -370,7 +455,9 @@ def get_status():
             }
         })
 
-    return {"torrents": torrent_infos}
+    response = {"torrents": torrent_infos}
+    _status_cache = (key, response)
+    return response
 
 
 class TorrentActionRequest(BaseModel):
@@ -420,8 +507,10 @@ def remove_torrent(req: TorrentActionRequest):
 
 @app.on_event("shutdown")
 def on_shutdown():
-    """saves session on shutdown"""
-    save_session()
+    """saves session on shutdown, bypassing the debounce"""
+    _save_pending.clear()
+    _write_session()
 
 
+threading.Thread(target=_session_writer, daemon=True, name="session-writer").start()
 load_session()
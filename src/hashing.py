@@ -0,0 +1,25 @@
+import hashlib
+
+
+def sha1_digest(data) -> bytes:
+    """
+    sha1 of a bytes-like object, the single entrypoint for piece and info hashes
+    uses OpenSSL's sha1 (SHA-NI where available), not flagged for security so FIPS builds allow it
+
+    Args:
+        data: bytes, bytearray, memoryview or mmap slice to hash
+
+    Returns:
+        the 20 byte digest
+    """
+    return hashlib.new("sha1", data, usedforsecurity=False).digest()
+
+
+def sha1_hasher():
+    """
+    fresh incremental sha1 object, for hashing a piece block by block as it arrives
+
+    Returns:
+        a hashlib sha1 object
+    """
+    return hashlib.new("sha1", usedforsecurity=False)
@@ -1,17 +1,28 @@
-import hashlib
-import struct
-from typing import List, Tuple, cast, Dict, Any
+from typing import List, Optional, Tuple, cast, Dict, Any
 
-import bencodepy
 import requests
+from requests.adapters import HTTPAdapter
 
-from .peer_connection import PeerConnection
+from .bencode import Bencode
+from .peer_connection import PeerConnection, peers_from_compact
 from .torrent_file import TorrentFile
 
+ANNOUNCE_TIMEOUT = 15  # seconds, so one unresponsive tracker can't stall an announce round
+
+# shared by every tracker client so repeat announces reuse pooled tcp / tls connections
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+
+# '%XX' for every byte value, so encoding is a table lookup per byte instead of formatting one
+_PCT_TABLE = tuple(f'%{i:02X}' for i in range(256))
+
 
 def percent_encode_bytes(b):
     """percent encodes a byte string"""
-    return ''.join(f'%{byte:02X}' for byte in b)
+    return ''.join(map(_PCT_TABLE.__getitem__, b))
 
 
 class HTTPTrackerClient:
@@ -39,6 +50,9 @@ class HTTPTrackerClient:
 
         self.tracker_url = tracker_url
 
+        # url and query parameters that never change, built on the first announce only
+        self._url_prefix: Optional[str] = None
+
     def get_peers(self, event: str) -> Tuple[List[PeerConnection], int]:
         """
         retrieve list of peers from tracker
@@ -52,48 +66,31 @@ class HTTPTrackerClient:
         Raises:
             Exception: tracker response is not 200
         """
-        info_bencoded = bencodepy.encode(self.torrent_file.info)
-        info_hash = hashlib.sha1(info_bencoded, usedforsecurity=False).digest()
-
-        url = self._build_url(info_hash, event)
+        url = self._build_url(event)
 
-        response = requests.get(url)
+        response = _session.get(url, timeout=ANNOUNCE_TIMEOUT)
 
         if response.status_code != 200:
             raise Exception(f"tracker error: {response.status_code}")
 
-        data = cast(Dict[bytes, Any], bencodepy.decode(response.content))
+        data = cast(Dict[bytes, Any], Bencode.decode_raw(response.content))
 
         interval = data.get(b'interval', 1800)
 
-        peers_binary = data[b'peers']
-
-        peers = []
-        for i in range(0, len(peers_binary), 6):
-            ip = ".".join(str(b) for b in peers_binary[i:i + 4])
-            port = struct.unpack(">H", peers_binary[i + 4:i + 6])[0]
-            peers.append(PeerConnection(ip, port, self.peer_id))
+        peers = peers_from_compact(data[b'peers'], self.peer_id)
 
         return peers, interval
 
-    def _build_url(self, info_hash: bytes, event):
+    def _build_url(self, event):
         """
         builds full tracker url with query parameters
 
         Args:
-            info_hash: sha1 hash of info dictionary
             event: tracker event request type
         """
-        params = {
-            'info_hash': percent_encode_bytes(info_hash),
-            'peer_id': self.peer_id,
-            'port': str(self.port),
-            'uploaded': 0,
-            'downloaded': 0,
-            'left': self.torrent_file.total_length,
-            'compact': 1,
-            'event': event
-        }
-
-        query = '&'.join(f"{key}={value}" for key, value in params.items())
-        return f"{self.tracker_url}?{query}"
+        if self._url_prefix is None:
+            self._url_prefix = (f"{self.tracker_url}?info_hash={percent_encode_bytes(self.torrent_file.info_hash)}"
+                                f"&peer_id={self.peer_id}&port={self.port}&compact=1")
+
+        return (f"{self._url_prefix}&uploaded=0&downloaded=0"
+                f"&left={self.torrent_file.total_length}&event={event}")
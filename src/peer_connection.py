@@ -1,15 +1,37 @@
 from __future__ import annotations
 
+import asyncio
 import socket
 import struct
 import time
-from typing import Optional, Dict, Any
+from collections import deque
+from typing import Optional, Dict, Any, List
 
 import bitarray
+from bitarray.util import zeros
 
 PROTOCOL_STRING = b"BitTorrent protocol"
 HANDSHAKE_LEN = 49 + len(PROTOCOL_STRING)
+_HANDSHAKE_PREFIX = bytes([len(PROTOCOL_STRING)]) + PROTOCOL_STRING  # pstrlen + pstr
 MAX_INFLIGHT = 40
+RECV_SIZE = 1 << 16  # fits a whole 16 KiB block plus headers in one read
+RECV_BATCH = 4  # max reads per wake-up, bounds how long one fast peer can hold the loop
+SOCK_BUFFER_SIZE = 1 << 20  # kernel send / receive buffer per peer socket
+RECV_COMPACT = 1 << 15  # consumed bytes kept at the head of the receive buffer before compacting
+RATE_BUCKET = 0.1  # seconds, transfers this close to the last speed sample are folded into it
+
+# precompiled wire formats
+_LENGTH = struct.Struct(">I")  # length prefix
+_HEADER = struct.Struct(">IB")  # length prefix + message id
+_HAVE = struct.Struct(">IBI")
+_PIECE_HEADER = struct.Struct(">IBII")
+_REQUEST = struct.Struct(">IBIII")
+_COMPACT_PEER = struct.Struct(">4sH")  # tracker compact peer list entry: ipv4 address, port
+
+# constant control messages, packed once
+_MSG_CHOKE = _HEADER.pack(1, 0)
+_MSG_UNCHOKE = _HEADER.pack(1, 1)
+_MSG_INTERESTED = _HEADER.pack(1, 2)
 
 
 class PeerConnection:
@@ -29,6 +51,7 @@ class PeerConnection:
         interested: True if this client is interested in peer's pieces
         remote_interested: True if remote peer is interested in this client's pieces
         bitmap: bitmap representing what pieces the peer has
+        have_count: number of pieces set in bitmap, kept in sync on have / bitfield
     """
 
     def __init__(self, ip: str, port: int, peer_id: str) -> None:
@@ -61,18 +84,26 @@ class PeerConnection:
 
         # availability
         self.bitmap: bitarray = None
+        self.have_count: int = 0
 
         # pipelining
         self._inflight: int = 0
 
         # incremental parsing
         self._recv_buffer: bytearray = bytearray()
+        self._recv_head: int = 0  # start of unparsed data in _recv_buffer
+
+        # outgoing bytes the socket has not accepted yet, flushed on EVENT_WRITE
+        self._send_buffer: bytearray = bytearray()
+        self._recv_view: memoryview = memoryview(bytearray(RECV_SIZE))  # reusable recv_into target
         self._bytes_needed: Optional[int] = None
 
         # accounting
         self.total_downloaded = 0
         self.total_uploaded = 0
-        self._rates = []  # timestamp, down, up
+        self._rates: deque = deque()  # timestamp, down, up
+        self._sum_down = 0  # running totals over the samples in _rates
+        self._sum_up = 0
 
     def connect(self, info_hash: bytes, handshake_timeout: float = 1.0) -> None:
         """
@@ -85,27 +116,89 @@ class PeerConnection:
         Raises:
             ConnectionError: if the handshake fails or socket closed
         """
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # sock stream = tcp
+        self.sock = self._open_socket()
         self.sock.settimeout(handshake_timeout)
         self.sock.connect((self.ip, self.port))
 
         # send handshake
+        self.sock.sendall(self._handshake(info_hash))
+
+        # receiving handshake and validation
+        response = self._recv_exact(HANDSHAKE_LEN, handshake_timeout)
+        self._validate_handshake(response, info_hash)
+
+        self._on_connected()
+
+    async def connect_async(self, info_hash: bytes, handshake_timeout: float = 1.0) -> None:
+        """
+        establishes tcp connection and performs handshake on the running event loop,
+        so many peers can be dialed concurrently from one thread
+
+        Args:
+            info_hash: SHA1 hash of the torrents info dictionary
+            handshake_timeout: timeout for connect and handshake in seconds
+
+        Raises:
+            ConnectionError: if the handshake fails, times out or socket closed
+        """
+        loop = asyncio.get_running_loop()
+        self.sock = self._open_socket()
+        self.sock.setblocking(False)
+
+        try:
+            response = await asyncio.wait_for(
+                self._handshake_async(loop, info_hash), handshake_timeout
+            )
+            self._validate_handshake(response, info_hash)
+        except asyncio.TimeoutError:
+            self.sock.close()
+            raise ConnectionError("handshake timed out")
+        except BaseException:
+            self.sock.close()
+            raise
+
+        self._on_connected()
+
+    async def _handshake_async(self, loop: asyncio.AbstractEventLoop, info_hash: bytes) -> bytes:
+        """connects, sends our handshake and reads the peer's, returns the raw response"""
+        await loop.sock_connect(self.sock, (self.ip, self.port))
+        await loop.sock_sendall(self.sock, self._handshake(info_hash))
+
+        buffer = bytearray()
+        while len(buffer) < HANDSHAKE_LEN:
+            part = await loop.sock_recv(self.sock, HANDSHAKE_LEN - len(buffer))
+            if not part:
+                raise ConnectionError("Socket closed")
+            buffer.extend(part)
+
+        return bytes(buffer)
+
+    @staticmethod
+    def _open_socket() -> socket.socket:
+        """creates a tcp socket tuned for peer traffic"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # sock stream = tcp
+        # small control messages (requests, haves) go out immediately instead of waiting on nagle,
+        # buffers are sized before connecting so the window scale is negotiated for them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUFFER_SIZE)
+        return sock
+
+    def _handshake(self, info_hash: bytes) -> bytes:
+        """builds our handshake message"""
         reserved = b'\x00' * 8
-        handshake = (
-                bytes([len(PROTOCOL_STRING)]) +
-                PROTOCOL_STRING +
+        return (
+                _HANDSHAKE_PREFIX +
                 reserved +
                 info_hash +
                 self.peer_id
         )
-        self.sock.sendall(handshake)
 
-        # receiving handshake and validation
-        response = self._recv_exact(HANDSHAKE_LEN, handshake_timeout)
-        self._validate_handshake(response, info_hash)
-
-        # completed, switch to non-blocking
+    def _on_connected(self) -> None:
+        """switches a handshaken socket to non-blocking and marks the connection active"""
         self.sock.setblocking(False)
+        if hasattr(socket, "TCP_QUICKACK"):  # linux only, skip delayed acks on request / piece exchanges
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
         self.active = True
 
     def close(self) -> None:
@@ -117,6 +210,7 @@ class PeerConnection:
             except Exception as e:
                 print(f"error closing socket: {self.ip}: {self.port} - {e}")
 
+        self._send_buffer.clear()
         self.active = False
 
     def send_interested(self) -> bool:
@@ -126,7 +220,7 @@ class PeerConnection:
         Returns:
             True on success, False otherwise
         """
-        return self._safe_send(struct.pack(">IB", 1, 2))
+        return self._safe_send(_MSG_INTERESTED)
 
     def send_choke(self) -> bool:
         """
@@ -135,8 +229,7 @@ class PeerConnection:
         Returns:
             True on success, False otherwise
         """
-        msg = struct.pack(">IB", 1, 0)
-        return self._safe_send(msg)
+        return self._safe_send(_MSG_CHOKE)
 
     def send_unchoke(self) -> bool:
         """
@@ -145,18 +238,18 @@ class PeerConnection:
         Returns:
             True on success, False otherwise
         """
-        msg = struct.pack(">IB", 1, 1)
-        return self._safe_send(msg)
+        return self._safe_send(_MSG_UNCHOKE)
 
     def send_have(self, index: int) -> bool:
         """
-        send peer a 'have' message
+        queues a 'have' message, it goes out with the next flush together with
+        whatever else is queued for this peer
 
         Returns:
-            True on success, False otherwise
+            True once queued
         """
-        msg = struct.pack(">IBI", 5, 4, index)
-        return self._safe_send(msg)
+        self._send_buffer += _HAVE.pack(5, 4, index)
+        return True
 
     def send_piece(self, index: int, start: int, data: bytes) -> bool:
         """
@@ -171,10 +264,52 @@ class PeerConnection:
             True on success, False otherwise
         """
         msg_length = 9 + len(data)
-        msg = struct.pack(">IBII", msg_length, 7, index, start) + data
+        msg = _PIECE_HEADER.pack(msg_length, 7, index, start) + data
         self.record_upload(len(data))
         return self._safe_send(msg)
 
+    def send_piece_from(self, index: int, start: int, storage, global_offset: int, length: int) -> bool:
+        """
+        send peer a 'piece' message with the block going from storage to the socket through
+        sendfile, so it isn't copied through python. whatever the socket doesn't take right
+        away, or everything if output is already queued, is copied into the send buffer
+
+        Args:
+            index: piece index
+            start: byte offset in the piece
+            storage: PieceStorage holding the block
+            global_offset: offset of the block in the full torrent
+            length: length of the block
+
+        Returns:
+            True on success, False otherwise
+        """
+        if self._send_buffer or not storage.can_sendfile:
+            return self.send_piece(index, start, storage.read(global_offset, length))
+
+        if not self._safe_send(_PIECE_HEADER.pack(9 + length, 7, index, start)):
+            return False
+
+        sent = 0
+        if not self._send_buffer:  # header went out whole, the block can follow it directly
+            try:
+                while sent < length:
+                    n = storage.sendfile(self.sock.fileno(), global_offset + sent, length - sent)
+                    if not n:
+                        break
+                    sent += n
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.active = False
+                return False
+
+        if sent < length:
+            self._send_buffer += storage.read(global_offset + sent, length - sent)
+
+        self.record_upload(length)
+        return True
+
     def send_bitfield(self, bitfield: bytes) -> bool:
         """
         sends a 'bitfield' message representing our available pieces
@@ -186,12 +321,13 @@ class PeerConnection:
             True if request was sent, False otherwise
         """
         msg_length = 1 + len(bitfield)
-        msg = struct.pack(">IB", msg_length, 5) + bitfield
+        msg = _HEADER.pack(msg_length, 5) + bitfield
         return self._safe_send(msg)
 
     def send_request(self, index: int, start: int, length: int) -> bool:
         """
-        sends a request for a block of data if total inflight under max
+        queues a request for a block of data if total inflight under max,
+        it goes out with the next flush
 
         Args:
             index: the piece index
@@ -199,17 +335,20 @@ class PeerConnection:
             length: length of the requested block
 
         Returns:
-            True if request was sent, False otherwise
+            True if request was queued, False otherwise
         """
         if self._inflight >= MAX_INFLIGHT or not self.active:
             return False
 
-        msg = struct.pack(">IBIII", 13, 6, index, start, length)
-        if self._safe_send(msg):
-            self._inflight += 1
-            return True
+        # queued rather than sent, a burst of requests leaves in a single send on the next flush
+        self._send_buffer += _REQUEST.pack(13, 6, index, start, length)
+        self._inflight += 1
+        return True
 
-        return False
+    @property
+    def free_slots(self) -> int:
+        """number of further block requests the pipeline accepts before reaching MAX_INFLIGHT"""
+        return max(0, MAX_INFLIGHT - self._inflight)
 
     def recv_message(self) -> Optional[Dict[str, Any]]:
         """
@@ -219,7 +358,7 @@ class PeerConnection:
             a dictionary with keys:
                 - 'type': either 'keep-alive' or 'message'
                 - 'id': message id (if type message)
-                - 'payload': message payload (if applicable)
+                - 'payload': message payload as a memoryview (if applicable)
 
             returns none if no message is available
 
@@ -229,24 +368,67 @@ class PeerConnection:
         if not self.active:
             return None
 
+        self._fill()
+        return self._next_message()
+
+    def recv_messages(self) -> List[Dict[str, Any]]:
+        """
+        non-blocking receive of every message available from this peer, reads the
+        socket once and then parses everything that is complete in the buffer
+
+        Returns:
+            list of message dictionaries, see recv_message
+
+        Raises:
+            ConnectionError: if remote peer closes the connection
+        """
+        if not self.active:
+            return []
+
+        self._fill()
+
+        messages = []
+        while True:
+            message = self._next_message()
+            if message is None:
+                return messages
+            messages.append(message)
+
+    def _fill(self) -> None:
+        """
+        reads whatever the socket has ready into the receive buffer, keeps reading while
+        reads come back full (up to RECV_BATCH of them) so one wake-up drains a busy socket
+
+        Raises:
+            ConnectionError: if remote peer closes the connection
+        """
+        view = self._recv_view
         try:
-            received = self.sock.recv(4096)
-            if received:
-                self._recv_buffer.extend(received)
-            else:
-                raise ConnectionError("Socket closed by peer")
+            for _ in range(RECV_BATCH):
+                n = self.sock.recv_into(view)
+                if not n:
+                    raise ConnectionError("Socket closed by peer")
+                self._recv_buffer += view[:n]
+                if n < RECV_SIZE:
+                    break  # short read, the socket is drained
 
         except BlockingIOError:
             # no data
             pass
 
+    def _next_message(self) -> Optional[Dict[str, Any]]:
+        """parses the next buffered message and updates pipelining state"""
         message = self._parse_one()
+        if message is None:
+            return None
 
         # we have to update self._inflight here
-        if message and message.get("id") == 7:  # piece
-            self._inflight = max(0, self._inflight - 1)
+        msg_id = message.get("id")
+        if msg_id == 7:  # piece
+            if self._inflight:
+                self._inflight -= 1
 
-        elif message and message.get("id") == 0:  # choke
+        elif msg_id == 0:  # choke
             # all pending requests are void
             self._inflight = 0
 
@@ -260,28 +442,51 @@ class PeerConnection:
             a dictionary with keys 'type', 'id', and 'payload', or None if message malformed
         """
 
+        buffer = self._recv_buffer
+        head = self._recv_head
+
         if self._bytes_needed is None:
-            if len(self._recv_buffer) < 4:
+            if len(buffer) - head < 4:
                 return None
 
-            length, = struct.unpack(">I", self._recv_buffer[:4])
-            del self._recv_buffer[:4]
+            length, = _LENGTH.unpack_from(buffer, head)
+            self._consume(head + 4)
+            head = self._recv_head
 
             if length == 0:
                 return {"type": "keep-alive"}
 
             self._bytes_needed = length
 
-        if len(self._recv_buffer) < self._bytes_needed:
+        end = head + self._bytes_needed
+        if len(buffer) < end:
             return None  # need to wait for more bytes
 
-        # received all
-        payload = self._recv_buffer[:self._bytes_needed]
-        del self._recv_buffer[:self._bytes_needed]
+        # received all. the payload is copied out once, so the buffer stays free to grow and
+        # compact, and exposed as a memoryview so consumers can slice it without copying again
+        msg_id = buffer[head]
+        payload = memoryview(buffer[head + 1:end])
         self._bytes_needed = None
+        self._consume(end)
+
+        return {"type": "message", "id": msg_id, "payload": payload}
 
-        msg_id = payload[0]
-        return {"type": "message", "id": msg_id, "payload": payload[1:]}
+    def _consume(self, head: int) -> None:
+        """
+        advances the parse position in _recv_buffer, reclaiming consumed bytes
+        only once the buffer is drained or the consumed prefix grows large
+
+        Args:
+            head: new start of unparsed data
+        """
+        buffer = self._recv_buffer
+        if head == len(buffer):
+            buffer.clear()
+            head = 0
+        elif head > RECV_COMPACT:
+            del buffer[:head]
+            head = 0
+        self._recv_head = head
 
     def _recv_exact(self, n: int, timeout: float) -> bytes:
 
@@ -299,25 +504,34 @@ class PeerConnection:
             ConnectionError: if peer closes the connection
         """
         self.sock.settimeout(timeout)
-        buffer = bytearray()
-
-        while len(buffer) < n:
-            part = self.sock.recv(n - len(buffer))
-            if not part:
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        received = 0
+
+        # read straight into the preallocated buffer instead of collecting partial chunks
+        while received < n:
+            count = self.sock.recv_into(view[received:], n - received)
+            if not count:
                 raise ConnectionError("Socket closed")
-            buffer.extend(part)
+            received += count
 
         return bytes(buffer)
 
     def _safe_send(self, payload: bytes) -> bool:
         """
-        sends payload to peer, deactivates peer on error
+        sends payload to peer, queueing whatever the socket does not accept right
+        away, deactivates peer on error
 
         Args:
             payload: raw bytes to send
         Returns:
-            True if payload was sent successfully, False otherwise
+            True if payload was sent or queued successfully, False otherwise
         """
+        if self._send_buffer:
+            # keep ordering behind bytes that are already waiting
+            self._send_buffer += payload
+            return True
+
         view = memoryview(payload)
         try:
             while view:
@@ -325,10 +539,42 @@ class PeerConnection:
                 view = view[sent:]
             return True
 
-        except (BlockingIOError, BrokenPipeError, ConnectionResetError, OSError):
+        except BlockingIOError:
+            self._send_buffer += view
+            return True
+
+        except (BrokenPipeError, ConnectionResetError, OSError):
             self.active = False
             return False
 
+    @property
+    def wants_write(self) -> bool:
+        """True while queued output is waiting for the socket to become writable"""
+        return bool(self._send_buffer)
+
+    def flush(self) -> bool:
+        """
+        sends as much queued output as the socket accepts, deactivates peer on error
+
+        Returns:
+            True if no output is left queued, False otherwise
+        """
+        buffer = self._send_buffer
+        if not buffer:
+            return True
+
+        try:
+            sent = self.sock.send(buffer)
+        except BlockingIOError:
+            return False
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            self._send_buffer.clear()
+            self.active = False
+            return False
+
+        del buffer[:sent]
+        return not buffer
+
     def _validate_handshake(self, response: bytes, info_hash: bytes) -> None:
         """
         validates the handshake response by checking info hash
@@ -343,11 +589,11 @@ class PeerConnection:
         if len(response) != HANDSHAKE_LEN:
             raise ConnectionError("incomplete handshake")
 
-        pstr_len = response[0]
-        if pstr_len != len(PROTOCOL_STRING) or response[1:1 + pstr_len] != PROTOCOL_STRING:
+        # length byte and protocol string checked in one memcmp, without slicing
+        if not response.startswith(_HANDSHAKE_PREFIX):
             raise ConnectionError("protocol string mismatch")
 
-        if response[1 + pstr_len + 8:1 + pstr_len + 8 + 20] != info_hash:
+        if response[len(_HANDSHAKE_PREFIX) + 8:len(_HANDSHAKE_PREFIX) + 28] != info_hash:
             raise ConnectionError("info hash wrong - wrong torrent")
 
         self.remote_id = response[-20:]  # last 20 bytes
@@ -360,29 +606,86 @@ class PeerConnection:
             num_pieces: the total number of pieces in the torrent
         """
         if self.bitmap is None:
-            self.bitmap = bitarray.bitarray(num_pieces)
-            self.bitmap.setall(0)
+            self.bitmap = zeros(num_pieces)
         elif len(self.bitmap) < num_pieces:
-            self.bitmap.extend([0] * (num_pieces - len(self.bitmap)))
+            self.bitmap.extend(zeros(num_pieces - len(self.bitmap)))
+
+    def mark_have(self, index: int) -> bool:
+        """
+        marks a piece as available from a 'have' message and updates have_count
+
+        Args:
+            index: the piece index
+
+        Returns:
+            True if the piece was not already marked, False otherwise
+        """
+        if self.bitmap[index]:
+            return False
+        self.bitmap[index] = 1
+        self.have_count += 1
+        return True
+
+    def set_bitfield(self, bitfield: bytes, num_pieces: int) -> None:
+        """
+        replaces the bitmap from a 'bitfield' message and recounts have_count
+
+        Args:
+            bitfield: bitfield payload as bytes
+            num_pieces: the total number of pieces in the torrent
+        """
+        # one copy out of the payload, then trimmed or zero-padded in place to the torrent size.
+        # not a buffer= view over the payload: have messages set bits in this bitmap later
+        bitmap = bitarray.bitarray()
+        bitmap.frombytes(bitfield)
+        if len(bitmap) >= num_pieces:
+            del bitmap[num_pieces:]  # drop spare trailing bits so they can't inflate the count
+        else:
+            bitmap.extend(zeros(num_pieces - len(bitmap)))
+
+        self.bitmap = bitmap
+        self.have_count = bitmap.count(1)  # C popcount, once per bitfield
 
     def record_download(self, n: int):
         """add downloaded bytes and speed sample"""
         self.total_downloaded += n
-        now = time.time()
-        self._rates.append((now, n, 0))
-        self.trim_samples(now)
+        self._add_sample(time.time(), n, 0)
 
     def record_upload(self, n: int):
         """add uploaded bytes and speed sample"""
         self.total_uploaded += n
-        now = time.time()
-        self._rates.append((now, 0, n))
+        self._add_sample(time.time(), 0, n)
+
+    def _add_sample(self, now: float, down: int, up: int):
+        """append a speed sample and keep the running totals in sync"""
+        self._sum_down += down
+        self._sum_up += up
+
+        # a busy peer delivers hundreds of blocks a second, bucketing keeps the sample
+        # window at ~window / RATE_BUCKET entries instead of one per block
+        rates = self._rates
+        if rates:
+            last, last_down, last_up = rates[-1]
+            if 0 <= now - last < RATE_BUCKET:
+                rates[-1] = (last, last_down + down, last_up + up)
+                return
+
+        rates.append((now, down, up))
         self.trim_samples(now)
 
     def trim_samples(self, now, window=10):
         """keep at most 'window' seconds of samples"""
-        while self._rates and now - self._rates[0][0] > window:
-            self._rates.pop(0)
+        rates = self._rates
+        while rates and now - rates[0][0] > window:
+            _, down, up = rates.popleft()
+            self._sum_down -= down
+            self._sum_up -= up
+
+    def clear_samples(self):
+        """drop all speed samples"""
+        self._rates.clear()
+        self._sum_down = 0
+        self._sum_up = 0
 
     def down_speed_bps(self) -> float:
         """average DL speed (bytes/s) over last 10s"""
@@ -395,15 +698,12 @@ class PeerConnection:
         if len(self._rates) < 2:
             return 0.0
 
-        oldest_time = self._rates[0][0]
-        elapsed = now - oldest_time
+        elapsed = now - self._rates[0][0]
 
         if elapsed < 2.0:
             return 0.0
 
-        bytes_dl = sum(s[1] for s in self._rates)
-        elapsed = max(1e-6, now - self._rates[0][0])
-        return bytes_dl / elapsed
+        return self._sum_down / max(1e-6, elapsed)
 
     def up_speed_bps(self) -> float:
         """average UL speed (bytes/s) over last 10s"""
@@ -413,10 +713,27 @@ class PeerConnection:
         if not self._rates:
             return 0.0
 
-        bytes_ul = sum(s[2] for s in self._rates)
         elapsed = max(1e-6, now - self._rates[0][0])
-        return bytes_ul / elapsed
+        return self._sum_up / elapsed
 
     @property
     def rates(self):
         return self._rates
+
+
+def peers_from_compact(data: bytes, peer_id: str) -> List[PeerConnection]:
+    """
+    parses a tracker's compact peer list, 6 bytes per peer (ipv4 address, port)
+
+    Args:
+        data: the compact peer list, a trailing partial entry is ignored
+        peer_id: local peer id for the new connections
+
+    Returns:
+        list of PeerConnections, one per entry
+    """
+    # iter_unpack walks the entries in C, inet_ntoa formats the address without per-byte joins
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % _COMPACT_PEER.size]
+    return [PeerConnection(socket.inet_ntoa(addr), port, peer_id)
+            for addr, port in _COMPACT_PEER.iter_unpack(view)]
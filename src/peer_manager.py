@@ -1,12 +1,18 @@
+import asyncio
+import heapq
+import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Set, Tuple
 
 from .peer_connection import PeerConnection
 from .piece_manager import PieceManager
 from .torrent_file import TorrentFile
 
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_CONNECTS = 256  # in-flight dials in connect_all, kept well under the default fd limit
+
 
 class PeerManager:
     """
@@ -17,6 +23,7 @@ class PeerManager:
         peers: a list of PeerConnection objects
         torrent_file: the associated TorrentFile object for this peer manager
         piece_manager: the associated PieceManager handling piece and block tracking
+        version: incremented whenever the peer list changes
     """
 
     def __init__(self, peers: List[PeerConnection], torrent_file: TorrentFile, piece_manager: PieceManager) -> None:
@@ -29,75 +36,125 @@ class PeerManager:
             piece_manager: the associated PieceManager handling piece and block tracking
         """
         self.peers: List[PeerConnection] = peers
+        self._seen: Set[Tuple[str, int]] = {(peer.ip, peer.port) for peer in peers}  # kept in sync with peers
         self.torrent_file = torrent_file
         self.piece_manager = piece_manager
 
         self.failed_peers: Dict[PeerConnection, int] = {}  # peer -> fail count
         self.next_retry_time: Dict[PeerConnection, datetime] = {}  # peer -> next retry timestamp
+        self._retry_heap: List[Tuple[datetime, int, PeerConnection]] = []  # (next retry, tiebreak, peer)
         self.max_failures = 5
         self.base_retry_interval = 10  # seconds
+        self.version = 0
 
         # threading
         self._stop_event: threading.Event = threading.Event()
         self._retry_thread: Optional[threading.Thread] = None
 
-    def _connect(self, peer):
-        try:
-            peer.connect(self.torrent_file.info_hash)
-            return peer
-        except Exception as e:
-            count = self.failed_peers.get(peer, 0) + 1
-            self.failed_peers[peer] = count
+    async def _connect_async(self, peer: PeerConnection, limit: asyncio.Semaphore) -> Optional[PeerConnection]:
+        async with limit:
+            try:
+                await peer.connect_async(self.torrent_file.info_hash)
+                return peer
+            except Exception as e:
+                logger.debug("[%s:%s] connect failed: %s", peer.ip, peer.port, e)
+                self._record_failure(peer)
+                return None
+
+    async def _connect_many_async(self, peers: List[PeerConnection]) -> List[Optional[PeerConnection]]:
+        limit = asyncio.Semaphore(MAX_CONCURRENT_CONNECTS)
+        return await asyncio.gather(*(self._connect_async(peer, limit) for peer in peers))
+
+    def _record_failure(self, peer: PeerConnection) -> None:
+        """counts a failed connection attempt and schedules the next retry with exponential backoff"""
+        count = self.failed_peers.get(peer, 0) + 1
+        self.failed_peers[peer] = count
+
+        # exp backoff: base * 2^(#fail - 1)
+        delay = self.base_retry_interval * (2 ** (count - 1))
+        self._schedule_retry(peer, datetime.now() + timedelta(seconds=delay))
+
+    def _schedule_retry(self, peer: PeerConnection, when: datetime) -> None:
+        """
+        records when a failed peer may be retried
+
+        Args:
+            peer: the peer that failed to connect
+            when: earliest time of the next attempt
+        """
+        self.next_retry_time[peer] = when
+        if self.failed_peers.get(peer, 0) < self.max_failures:
+            heapq.heappush(self._retry_heap, (when, id(peer), peer))
+
+    def _pop_due(self, now: datetime) -> List[PeerConnection]:
+        """
+        pops every peer whose retry time has passed, skipping entries that went stale
+        because the peer connected or was forgotten since it was scheduled
 
-            # exp backoff: base * 2^(#fail - 1)
-            delay = self.base_retry_interval * (2 ** (count - 1))
-            self.next_retry_time[peer] = datetime.now() + timedelta(seconds=delay)
+        Args:
+            now: current time
 
-            return None
+        Returns:
+            peers that are due for a retry
+        """
+        due = []
+        heap = self._retry_heap
+        while heap and heap[0][0] <= now:
+            when, _, peer = heapq.heappop(heap)
+            if self.next_retry_time.get(peer) == when:
+                due.append(peer)
+        return due
 
     def connect_all(self) -> None:
         """
         attempts to connect to all known peers, filters active peers and tracks failed for retry
+        dials run concurrently on a private event loop instead of one thread per peer
         """
+        results = asyncio.run(self._connect_many_async(self.peers))
 
-        alive = []
-        with ThreadPoolExecutor(max_workers=120) as pool:
-            futures = {pool.submit(self._connect, peer) for peer in self.peers}
-            for future in as_completed(futures):
-                peer = future.result()
-                if peer:
-                    alive.append(peer)
-
-        self.peers = alive
+        self.peers = [peer for peer in results if peer]
+        self._seen = {(peer.ip, peer.port) for peer in self.peers}
+        self.version += 1
 
     def retry_failed_peers(self) -> None:
         """
-        retries failed peers if their backoff time has passed
+        retries failed peers if their backoff time has passed, dialing them
+        concurrently on a private event loop like connect_all
         """
-        now = datetime.now()
-
-        retry = [
-            peer for peer, time in self.next_retry_time.items()
-            if now >= time and self.failed_peers.get(peer, 0) < self.max_failures
-        ]
+        retry = self._pop_due(datetime.now())
 
         if not retry:
             return
 
-        with ThreadPoolExecutor(max_workers=30) as pool:
-            futures = {pool.submit(self._connect, peer) for peer in retry}
-            for future in as_completed(futures):
-                peer = future.result()
-                if peer:
-                    self.peers.append(peer)
-                    self.failed_peers.pop(peer, None)
-                    self.next_retry_time.pop(peer, None)
+        for peer in asyncio.run(self._connect_many_async(retry)):
+            if peer:
+                self.peers.append(peer)
+                self._seen.add((peer.ip, peer.port))
+                self.failed_peers.pop(peer, None)
+                self.next_retry_time.pop(peer, None)
+                self.version += 1
+
+    def _seconds_until_due(self, now: datetime, check_interval: float) -> float:
+        """
+        how long the retry worker can sleep, until the earliest scheduled retry
+        but never longer than check_interval
+
+        Args:
+            now: current time
+            check_interval: upper bound in seconds
+
+        Returns:
+            seconds to wait, 0 if a retry is already due
+        """
+        if not self._retry_heap:
+            return check_interval
+        return max(0.0, min(check_interval, (self._retry_heap[0][0] - now).total_seconds()))
 
     def retry_worker(self, check_interval: int = 10):
         """background thread for retrying failed peers with backoff"""
         while not self._stop_event.is_set():
             self.retry_failed_peers()
-            self._stop_event.wait(check_interval)
+            self._stop_event.wait(self._seconds_until_due(datetime.now(), check_interval))
 
     def start_retry_worker(self):
         if self._retry_thread and self._retry_thread.is_alive():
@@ -114,12 +171,31 @@ class PeerManager:
         if self._retry_thread:
             self._retry_thread.join()
 
+    def unknown_peers(self, peers: List[PeerConnection]) -> List[PeerConnection]:
+        """
+        filters tracker results down to peers that are not already in the peer list,
+        matching on (ip, port) so several peers behind one NAT address are kept
+
+        Args:
+            peers: candidate peers, e.g. from an announce
+
+        Returns:
+            the candidates whose address is not known yet
+        """
+        seen = self._seen
+        return [peer for peer in peers if (peer.ip, peer.port) not in seen]
+
     def add_peer(self, peer: PeerConnection):
         self.peers.append(peer)
+        self._seen.add((peer.ip, peer.port))
+        self.version += 1
 
     def remove_peer(self, peer: PeerConnection):
         self.peers.remove(peer)
+        self._seen.discard((peer.ip, peer.port))
+        self.version += 1
         peer.close()
+        self.piece_manager.on_choke(peer)  # its requests will never be answered
         if peer.bitmap is not None:
             self.piece_manager.peer_disconnect(peer.bitmap)
 
@@ -129,5 +205,8 @@ class PeerManager:
             if peer.bitmap:
                 self.piece_manager.peer_disconnect(peer.bitmap)
         self.peers.clear()
+        self._seen.clear()
+        self.version += 1
         self.failed_peers.clear()
         self.next_retry_time.clear()
+        self._retry_heap.clear()
@@ -1,7 +1,7 @@
-import hashlib
 from typing import List, Optional
 
 from .block import Block
+from .hashing import sha1_hasher
 from .storage_manager import PieceStorage
 
 
@@ -15,7 +15,7 @@ class Piece:
         length: length of the piece in bytes
         block_size: size of each block within the piece
         is_complete: True if this piece is downloaded and verified
-        blocks: List of Block instances in this piece
+        blocks: List of Block instances in this piece, built on first access
         piece_storage: PieceStorage instance
         base_offset: the start offset of the piece in the stream
 
@@ -27,14 +27,14 @@ class Piece:
         initializes
         Attributes:
             index: the piece index
-            sha1: the expected sha1 hash
+            sha1: the expected sha1 hash, or the torrent's concatenated hash table to look it up in by index
             length: length of the piece in bytes
             block_size: size of each block within the piece
             piece_storage: PieceStorage instance
             base_offset: the start offset of the piece in the stream
         """
         self.index: int = index
-        self.sha1: bytes = sha1
+        self._sha1: bytes = sha1  # shared by every piece when it is the whole table, see sha1
         self.length: int = length
         self.block_size: int = block_size
         self.is_complete: bool = False
@@ -42,16 +42,42 @@ class Piece:
         self.piece_storage: PieceStorage = piece_storage
         self.base_offset: int = base_offset
 
-        # slice piece into blocks
-        self.blocks: List[Block] = [
+        # Block objects are only built once the piece is first touched, see blocks, so pieces
+        # that are already on disk (or never get selected) cost no per-block objects at all
+        self._blocks: Optional[List[Block]] = None
+        self._num_blocks: int = -(-length // block_size)
 
-            Block(index, offset, min(block_size, length - offset))
-            for offset in range(0, length, block_size)
-
-        ]
-
-        self._buffer: bytearray = bytearray(length)  # in memory storage for sha1 verification
         self._blocks_received: int = 0  # tracks how many blocks we've received
+        self._next_block_cursor: int = 0  # every block before this index is requested or received
+
+        # running sha1 over the contiguous prefix of received blocks
+        self._hasher = sha1_hasher()
+        self._hashed_blocks: int = 0
+
+    @property
+    def sha1(self) -> bytes:
+        """the expected sha1 hash, sliced out of the hash table only when it is compared"""
+        table = self._sha1
+        if len(table) == 20:
+            return table
+        return table[self.index * 20:self.index * 20 + 20]
+
+    @property
+    def blocks(self) -> List[Block]:
+        """the piece sliced into blocks, built on first access"""
+        if self._blocks is None:
+            self._blocks = [
+                Block(self.index, offset, min(self.block_size, self.length - offset))
+                for offset in range(0, self.length, self.block_size)
+            ]
+            if self.is_complete:
+                for block in self._blocks:
+                    block.is_received = True
+        return self._blocks
+
+    @blocks.setter
+    def blocks(self, blocks: List[Block]) -> None:
+        self._blocks = blocks
 
     def next_block(self) -> Optional[Block]:
         """
@@ -60,12 +86,45 @@ class Piece:
         Returns:
             a Block ready for request, or None if none are available
         """
-        for block in self.blocks:
+        # walk on locals and store the cursor back once, instead of an attribute round trip per block
+        cursor = self._next_block_cursor
+        num_blocks = self._num_blocks
+        if cursor >= num_blocks:
+            return None  # exhausted, don't build blocks just to find that out
+
+        blocks = self.blocks
+
+        while cursor < num_blocks:
+            block = blocks[cursor]
+            cursor += 1
             if not block.is_requested and not block.is_received:
+                self._next_block_cursor = cursor
                 block.set_requested()
                 return block
+
+        self._next_block_cursor = cursor
         return None
 
+    def requeue(self, block: Block) -> None:
+        """
+        resets a requested block that was never received so next_block hands it out again
+
+        Args:
+            block: a block of this piece
+        """
+        block.reset()
+        self._next_block_cursor = min(self._next_block_cursor, block.offset // self.block_size)
+
+    def mark_complete(self) -> None:
+        """marks the piece and all its blocks as received and verified, e.g. when found intact on disk"""
+        self.is_complete = True
+        if self._blocks is not None:  # otherwise blocks are built already received
+            for block in self._blocks:
+                block.is_received = True
+        self._blocks_received = self._num_blocks
+        self._next_block_cursor = self._num_blocks
+        self._hashed_blocks = self._num_blocks
+
     def block_received(self, offset: int, data: bytes) -> Optional[bool]:
         """
         verifies a received block
@@ -79,14 +138,13 @@ class Piece:
             False if block accepted, but piece not complete
             None if block was invalid or already received
         """
-        # find matching block
-        block = None
-        for b in self.blocks:
-            if b.offset == offset:
-                block = b
-                break
-
-        if block is None or len(data) != block.length:
+        # blocks sit at fixed block_size strides, so the offset gives the index directly
+        block_index, remainder = divmod(offset, self.block_size)
+        if remainder or not 0 <= block_index < self._num_blocks:
+            return
+
+        block = self.blocks[block_index]
+        if len(data) != block.length:
             return
 
         if block.is_received:
@@ -94,22 +152,48 @@ class Piece:
 
         self.piece_storage.write(self.index, offset, data)
 
-        # store into our buffer
-        self._buffer[offset:offset + block.length] = data
         block.is_received = True
         self._blocks_received += 1
+        self._advance_hash(block_index, data)
 
-        if self._blocks_received == len(self.blocks):  # piece complete
-            if hashlib.sha1(self._buffer, usedforsecurity=False).digest() == self.sha1:
+        if self._blocks_received == self._num_blocks:  # piece complete
+            if self._hasher.digest() == self.sha1:
                 self.is_complete = True
-                # free buffer to save space
-                self._buffer = bytearray()
                 return True
             else:
                 # bad hash – reset state
                 self.is_complete = False
                 self._blocks_received = 0
+                self._next_block_cursor = 0
+                self._hasher = sha1_hasher()
+                self._hashed_blocks = 0
                 for b in self.blocks:
                     b.reset()
 
         return False
+
+    def _advance_hash(self, block_index: int, data: bytes) -> None:
+        """
+        feeds the running hash once the hashed prefix reaches a block, blocks that
+        arrived early are read back from storage when the gap before them fills
+
+        Args:
+            block_index: index of the block just received
+            data: its data
+        """
+        if block_index != self._hashed_blocks:
+            return
+
+        self._hasher.update(data)
+        self._hashed_blocks += 1
+
+        # early blocks that now follow the hashed prefix are contiguous in storage, so the
+        # whole run goes through the hasher as one view of the mapping instead of block by block
+        first = self._hashed_blocks
+        while self._hashed_blocks < self._num_blocks and self.blocks[self._hashed_blocks].is_received:
+            self._hashed_blocks += 1
+
+        if self._hashed_blocks > first:
+            start = self.blocks[first].offset
+            last = self.blocks[self._hashed_blocks - 1]
+            self._hasher.update(self.piece_storage.view(self.base_offset + start, last.offset + last.length - start))
@@ -2,10 +2,12 @@
 
 import random
 import time
-from collections import Counter, defaultdict
-from typing import Optional, List
+from itertools import chain
+from collections import deque
+from typing import Optional, List, Deque, Dict, Tuple
 
 from bitarray import bitarray
+from bitarray.util import zeros
 
 from .block import Block
 from .peer_connection import PeerConnection
@@ -34,9 +36,10 @@ class PieceManager:
         block_size: size of individual blocks
         piece_storage: piece storage manager
         pieces: list of Piece objects representing the torrent pieces
-        availability: counter tracking how many peers have each piece
-        inflight_by_peer: maps each PeerConnection to the blocks currently in-flight
+        availability: per piece index, how many connected peers have that piece
+        inflight: maps (piece index, offset) of every block in flight to the peer it was requested from
         downloaded_bytes: total number of bytes downloaded
+        version: incremented whenever download progress changes
     """
 
     def __init__(self, torrent_file: TorrentFile, piece_storage: PieceStorage, block_size: int = BLOCK_SIZE) -> None:
@@ -53,113 +56,206 @@ class PieceManager:
 
         self.piece_storage = piece_storage
 
-        self._hashes = [
-            torrent_file.pieces[i:i + 20]
-            for i in range(0, len(torrent_file.pieces), 20)
-        ]
-
-        self._lengths = _calculate_pieces_lengths(
-            torrent_file.total_length, torrent_file.piece_length
-        )
+        # every piece shares the one concatenated digest buffer from the torrent file and
+        # slices its own digest out when it needs it, so no per-piece hash objects are kept
+        hashes = torrent_file.pieces
+        lengths = _calculate_pieces_lengths(torrent_file.total_length, torrent_file.piece_length)
 
         self.pieces: list[Piece] = [
-            Piece(i, self._hashes[i], self._lengths[i], block_size, self.piece_storage,
+            Piece(i, hashes, length, block_size, self.piece_storage,
                   base_offset=i * torrent_file.piece_length)
-            for i in range(len(self._hashes))
+            for i, length in enumerate(lengths)
         ]
 
-        self.availability = Counter()
+        # fixed size and indexed directly, no hashing or .get() default on the selection path
+        self.availability: List[int] = [0] * len(self.pieces)
+
+        # rarest first index: _levels[k] has a bit set for every piece exactly k peers have, and
+        # _level_sizes[k] counts them, so selection ANDs level by level from the rarest non-empty one
+        self._levels: List[bitarray] = [bitarray(len(self.pieces))]
+        self._levels[0].setall(1)
+        self._level_sizes: List[int] = [len(self.pieces)]
+
+        # hint of pieces that may still have blocks to request. bits are cleared once a piece
+        # completes or has nothing left to hand out, and set again whenever its blocks are reset
+        self._needs_piece = bitarray(len(self.pieces))
+        self._needs_piece.setall(1)
+
+        # keyed by block so a received block is dropped in O(1), a choke filters by peer
+        self.inflight: Dict[Tuple[int, int], PeerConnection] = {}
+
+        # (request time, block) for every block handed out, oldest first, so tick only looks
+        # at the front instead of walking every block of every piece
+        self._requested: Deque[Tuple[float, Block]] = deque()
 
-        self.inflight_by_peer: dict[PeerConnection, List[Block]] = defaultdict(list)
+        # pieces completed and verified, so is_finished doesn't walk every piece on each loop turn
+        self._completed_count = 0
 
         self.downloaded_bytes = 0
+        self.version = 0
 
     def add_have(self, index: int) -> None:
         """
         gets called for every "have", updates piece availability
         """
-        self.availability[index] += 1
+        self._move_level(index, self.availability[index] + 1)
 
     def add_bitmap(self, bitmap: bitarray) -> None:
         """
         called for initial bitmap for each peer, updates availability from full bitmap
         """
-        for idx, have in enumerate(bitmap):
-            if have:
-                self.availability[idx] += 1
+        availability = self.availability
+        # search walks the set bits in C instead of indexing every bit from python
+        for idx in bitmap.search(1, 0, len(availability)):
+            self._move_level(idx, availability[idx] + 1)
 
     def peer_disconnect(self, bitmap: bitarray) -> None:
         """
         called when peer disconnects, updates availability from last known bitmap
         """
-        for idx, have in enumerate(bitmap):
-            if have:
-                self.availability[idx] = max(0, self.availability[idx] - 1)
+        availability = self.availability
+        for idx in bitmap.search(1, 0, len(availability)):
+            if availability[idx]:
+                self._move_level(idx, availability[idx] - 1)
+
+    def _move_level(self, index: int, level: int) -> None:
+        """
+        sets a piece's availability and moves it to the matching rarest first level
+
+        Args:
+            index: the piece index
+            level: its new availability
+        """
+        old = self.availability[index]
+        self.availability[index] = level
+
+        if level == len(self._levels):
+            self._levels.append(zeros(len(self.pieces)))
+            self._level_sizes.append(0)
+
+        self._levels[old][index] = 0
+        self._level_sizes[old] -= 1
+        self._levels[level][index] = 1
+        self._level_sizes[level] += 1
 
     def on_choke(self, peer: PeerConnection) -> None:
         """
         called when peer chokes this client, handles state reset
         """
-        for block in self.inflight_by_peer.pop(peer, []):
-            block.reset()
+        choked = [key for key, owner in self.inflight.items() if owner is peer]
+        for piece_index, offset in choked:
+            del self.inflight[piece_index, offset]
+            piece = self.pieces[piece_index]
+            block = piece.blocks[offset // piece.block_size]
+            if block.is_requested and not block.is_received:
+                piece.requeue(block)
+                self._needs_piece[piece_index] = 1
+
+    def _wanted_from(self, peer_bitmap: bitarray) -> bitarray:
+        """
+        pieces the peer has that may still need requesting, as a single C level AND
+
+        Args:
+            peer_bitmap: bitmap of corresponding peer
 
-    def next_request(self, peer_bitmap: bitarray) -> Optional[Block]:
+        Returns:
+            bitarray with a bit set for every candidate piece index
+        """
+        num_pieces = len(self._needs_piece)
+        if len(peer_bitmap) != num_pieces:
+            peer_bitmap = peer_bitmap[:num_pieces]
+            peer_bitmap.extend(zeros(num_pieces - len(peer_bitmap)))
+        return peer_bitmap & self._needs_piece
+
+    def next_request(self, peer_bitmap: bitarray, peer: Optional[PeerConnection] = None) -> Optional[Block]:
         """
         returns next block that can be requested from a peer
 
         Args:
             peer_bitmap: bitmap of corresponding peer
+            peer: the peer the block will be requested from, recorded in inflight if given
 
         Returns:
             Block instance ready to be requested, or None of no blocks are available
         """
-        for piece in self.pieces:
-            if piece.is_complete or not peer_bitmap[piece.index]:
-                continue
-            block = piece.next_block()
-            if block is not None:
-                return block
+        for index in self._wanted_from(peer_bitmap).search(1):
+            piece = self.pieces[index]
+            if not piece.is_complete:
+                block = piece.next_block()
+                if block is not None:
+                    return self._track(block, peer)
+            self._needs_piece[index] = 0
 
         return None
 
-    def next_request_rarest_first(self, peer_bitmap: bitarray) -> Optional[Block]:
+    def next_request_rarest_first(self, peer_bitmap: bitarray,
+                                  peer: Optional[PeerConnection] = None) -> Optional[Block]:
         """
         returns next block that can be requested from a peer
         follows the rarest piece first algorithm
 
         Args:
             peer_bitmap: bitmap of corresponding peer
+            peer: the peer the block will be requested from, recorded in inflight if given
 
         Returns:
             Block instance ready to be requested, or None of no blocks are available
         """
-        choices = [
-            piece for piece in self.pieces
-            if (not piece.is_complete) and peer_bitmap[piece.index]
-        ]
-        if not choices:
-            return None
+        blocks = self.next_requests_rarest_first(peer_bitmap, 1, peer)
+        return blocks[0] if blocks else None
 
-        # find the lowest avail
-        min_avail = min(self.availability.get(piece.index, 0) for piece in choices)
+    def next_requests_rarest_first(self, peer_bitmap: bitarray, count: int,
+                                   peer: Optional[PeerConnection] = None) -> List[Block]:
+        """
+        returns up to count blocks that can be requested from a peer in one selection pass,
+        follows the rarest piece first algorithm and drains a piece before moving to the next
 
-        rarest = [
-            piece for piece in choices if self.availability.get(piece.index, 0) == min_avail
-        ]
+        Args:
+            peer_bitmap: bitmap of corresponding peer
+            count: maximum number of blocks to return
+            peer: the peer the blocks will be requested from, recorded in inflight if given
 
-        random.shuffle(rarest)
-        for piece in rarest:
-            block = piece.next_block()
-            if block:
-                return block
+        Returns:
+            list of Block instances ready to be requested, empty if none are available
+        """
+        blocks: List[Block] = []
+        if count <= 0:
+            return blocks
 
-        # every rare piece is requested already
-        for piece in choices:
-            block = piece.next_block()
-            if block:
-                return block
+        wanted = self._wanted_from(peer_bitmap)
+        if not wanted.any():
+            return blocks
 
-        return None
+        num_pieces = len(wanted)
+        for level, size in zip(self._levels, self._level_sizes):
+            if not size:
+                continue
+
+            candidates = wanted & level
+            if not candidates.any():
+                continue
+
+            # start at a random index so peers spread over the equally rare pieces
+            start = random.randrange(num_pieces)
+            for index in chain(candidates.search(1, start), candidates.search(1, 0, start)):
+                piece = self.pieces[index]
+                if not piece.is_complete:
+                    block = piece.next_block()
+                    while block is not None:
+                        blocks.append(self._track(block, peer))
+                        if len(blocks) == count:
+                            return blocks
+                        block = piece.next_block()
+                self._needs_piece[index] = 0
+
+        return blocks
+
+    def _track(self, block: Block, peer: Optional[PeerConnection]) -> Block:
+        """remembers a block that was just handed out so tick can time it out, and who it went to"""
+        self._requested.append((block.request_time, block))
+        if peer is not None:
+            self.inflight[block.piece_index, block.offset] = peer
+        return block
 
     def block_received(self, piece_index: int, offset: int, data: bytes) -> Optional[bool]:
         """
@@ -175,9 +271,21 @@ class PieceManager:
             False if block accepted, but piece not complete
             None if block was invalid or already received
         """
-        result = self.pieces[piece_index].block_received(offset, data)
+        self.inflight.pop((piece_index, offset), None)
+
+        piece = self.pieces[piece_index]
+        result = piece.block_received(offset, data)
         if result in (True, False):
             self.downloaded_bytes += len(data)
+            self.version += 1
+
+        if result is True:
+            self._needs_piece[piece_index] = 0
+            self._completed_count += 1
+
+        elif result is False and not piece.blocks[offset // piece.block_size].is_received:
+            # failed the hash check and the piece was reset, its blocks can be requested again
+            self._needs_piece[piece_index] = 1
 
         return result
 
@@ -188,16 +296,40 @@ class PieceManager:
         Returns:
             True if all pieces are downloaded, False otherwise.
         """
-        return all(piece.is_complete for piece in self.pieces)
+        return self._completed_count == len(self.pieces)
+
+    def mark_complete(self, piece_index: int) -> None:
+        """
+        marks a piece as complete without downloading it, e.g. when found intact on disk
+
+        Args:
+            piece_index: index of the piece
+        """
+        piece = self.pieces[piece_index]
+        if not piece.is_complete:
+            self._completed_count += 1
+        piece.mark_complete()
+        self._needs_piece[piece_index] = 0
 
     def tick(self) -> None:
         """resets timed-out requests"""
-        now = time.time()
-        for piece in self.pieces:
-            if piece.is_complete:
+        now = time.monotonic()
+        requested = self._requested
+
+        while requested:
+            handed_out, block = requested[0]
+            request_time = block.request_time
+
+            # received, already reset, or requested again later (a newer entry follows)
+            if (not block.is_requested or block.is_received or request_time is None
+                    or request_time > handed_out):
+                requested.popleft()
                 continue
-            for block in piece.blocks:
-                if block.is_requested and not block.is_received:
-                    if block.request_time is not None and (now - block.request_time >= REQUEST_TIMEOUT):
-                        block.is_requested = False
-                        block.request_time = None
+
+            if now - request_time < REQUEST_TIMEOUT:
+                break  # entries are in request order, nothing behind this one is older
+
+            requested.popleft()
+            self.inflight.pop((block.piece_index, block.offset), None)
+            self.pieces[block.piece_index].requeue(block)
+            self._needs_piece[block.piece_index] = 1
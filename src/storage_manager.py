@@ -2,9 +2,109 @@ import mmap
 import os
 import pathlib
 import shutil
+from collections import OrderedDict
+from typing import Iterator, Optional, Tuple
 
 from .torrent_file import TorrentFile
 
+MMAP_WINDOW_THRESHOLD = 1 << 32  # torrents above this are mapped in segments instead of all at once
+SEGMENT_SIZE = 256 << 20  # multiple of mmap.ALLOCATIONGRANULARITY on every platform
+MAX_SEGMENTS = 8
+COPY_CHUNK_SIZE = 1 << 20  # read / write size when the kernel can't copy for us
+
+
+class _SegmentedMap:
+    """
+    mmap-like window over a file too large to map at once, maps fixed size segments on
+    demand and keeps only the most recently used ones, so the mapped footprint stays bounded
+
+    supports the subset of the mmap api PieceStorage uses: slice get / set, flush, close, madvise
+    """
+
+    def __init__(self, fileno: int, length: int, access: int,
+                 segment_size: int = SEGMENT_SIZE, max_segments: int = MAX_SEGMENTS) -> None:
+        """
+        initializes the window, no segment is mapped until it is first accessed
+
+        Args:
+            fileno: file descriptor of the backing file
+            length: number of bytes to expose
+            access: mmap.ACCESS_WRITE or mmap.ACCESS_READ
+            segment_size: bytes per segment, a multiple of mmap.ALLOCATIONGRANULARITY
+            max_segments: segments kept mapped at once
+        """
+        self._fileno = fileno
+        self._length = length
+        self._access = access
+        self._segment_size = segment_size
+        self._max_segments = max_segments
+        self._segments: OrderedDict[int, mmap.mmap] = OrderedDict()
+        self._advice: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, key: slice) -> bytes:
+        start, stop, _ = key.indices(self._length)
+        parts = [segment[a:b] for segment, a, b in self._spans(start, stop)]
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def __setitem__(self, key: slice, data) -> None:
+        start, stop, _ = key.indices(self._length)
+        if stop - start != len(data):
+            raise IndexError("mmap slice assignment is wrong size")
+
+        view = memoryview(data)
+        pos = 0
+        for segment, a, b in self._spans(start, stop):
+            segment[a:b] = view[pos:pos + b - a]
+            pos += b - a
+
+    def flush(self) -> None:
+        for segment in self._segments.values():
+            segment.flush()
+
+    def close(self) -> None:
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+    def madvise(self, advice: int) -> None:
+        self._advice = advice
+        for segment in self._segments.values():
+            segment.madvise(advice)
+
+    def _spans(self, start: int, stop: int) -> Iterator[Tuple[mmap.mmap, int, int]]:
+        """yields (segment, start, stop) pieces covering [start, stop), split at segment borders"""
+        while start < stop:
+            index, offset = divmod(start, self._segment_size)
+            n = min(stop - start, self._segment_size - offset)
+            yield self._segment(index), offset, offset + n
+            start += n
+
+    def _segment(self, index: int) -> mmap.mmap:
+        """returns the mapped segment, mapping it and evicting the least recently used one if needed"""
+        segment = self._segments.get(index)
+        if segment is not None:
+            self._segments.move_to_end(index)
+            return segment
+
+        offset = index * self._segment_size
+        segment = mmap.mmap(self._fileno, min(self._segment_size, self._length - offset),
+                            access=self._access, offset=offset)
+        if self._advice is not None:
+            segment.madvise(self._advice)
+        self._segments[index] = segment
+
+        while len(self._segments) > self._max_segments:
+            _, evicted = self._segments.popitem(last=False)
+            evicted.flush()
+            evicted.close()
+
+        return segment
+
 
 class PieceStorage:
     """
@@ -17,7 +117,7 @@ class PieceStorage:
         part_path: path to the temporary .part during downloading
         final_path: final path for single file torrents, None for multi-file
         _fd: open file descriptor
-        _mmap: memory mapped file
+        _mmap: memory mapped file, a segmented window for torrents over MMAP_WINDOW_THRESHOLD
         _read_only: True if mmap is in read only mode
     """
 
@@ -46,12 +146,12 @@ class PieceStorage:
         # create part file if it doesn't exist
         if not self.part_path.exists():
             with open(self.part_path, "wb") as f:
-                f.truncate(self.torrent_file.total_length)
+                _preallocate(f.fileno(), self.torrent_file.total_length)
 
         self._fd = open(self.part_path, "r+b")
-        self._mmap = mmap.mmap(self._fd.fileno(),
-                               self.torrent_file.total_length,
-                               access=mmap.ACCESS_WRITE)
+        self._mmap = self._map(mmap.ACCESS_WRITE)
+        # startup verification sweeps the file front to back, and blocks land in order within a piece
+        self._advise("MADV_SEQUENTIAL", "POSIX_FADV_SEQUENTIAL")
 
         self._read_only = False
 
@@ -65,6 +165,7 @@ class PieceStorage:
             data: the data to write
         """
         start = piece_index * self.torrent_file.piece_length + piece_offset
+        # slice assignment copies straight from data's buffer into the mapping, memoryview payloads included
         self._mmap[start: start + len(data)] = data
 
     def read(self, global_offset: int, length: int) -> bytes:
@@ -80,6 +181,52 @@ class PieceStorage:
         """
         return self._mmap[global_offset: global_offset + length]
 
+    def view(self, global_offset: int, length: int) -> memoryview:
+        """
+        zero-copy view of mapped data, for consumers like hashing that only read it once.
+        the mmap cannot be closed while a view is alive, so don't keep it around
+
+        Args:
+            global_offset: offset in the full torrent to start reading
+            length: number of bytes to view
+
+        Returns:
+            memoryview over the requested bytes
+        """
+        if isinstance(self._mmap, _SegmentedMap):
+            # segments get evicted, so never hand out a view that would pin one
+            return memoryview(self._mmap[global_offset: global_offset + length])
+        return memoryview(self._mmap)[global_offset: global_offset + length]
+
+    @property
+    def can_sendfile(self) -> bool:
+        """True if blocks can be sent to a socket straight from the file, see sendfile"""
+        return hasattr(os, "sendfile")
+
+    def sendfile(self, out_fd: int, global_offset: int, length: int) -> int:
+        """
+        sends bytes from the backing file straight to a socket in the kernel, without
+        copying them through python. the whole torrent always sits in one file, the
+        .part file while downloading and the file reopened for seeding after that
+
+        Args:
+            out_fd: file descriptor of the socket
+            global_offset: offset in the full torrent to start sending from
+            length: number of bytes to send
+
+        Returns:
+            number of bytes sent, which may be less than length
+
+        Raises:
+            BlockingIOError: if the socket is non blocking and full
+        """
+        return os.sendfile(out_fd, self._fd.fileno(), global_offset, length)
+
+    @property
+    def concurrent_reads(self) -> bool:
+        """True if read / view may be called from several threads at once, windowed maps evict segments"""
+        return not isinstance(self._mmap, _SegmentedMap)
+
     def switch_to_seeding(self):
         """
         flushes and closes the mmap, moves data into correct files, and reopens a read only mmap
@@ -105,11 +252,46 @@ class PieceStorage:
 
         # open the file in read only for seeding
         self._fd = open(reopen_path, "rb")
-        self._mmap = mmap.mmap(self._fd.fileno(),
-                               self.torrent_file.total_length,
-                               access=mmap.ACCESS_READ)
+        self._mmap = self._map(mmap.ACCESS_READ)
+        # peers request blocks from anywhere, readahead would only evict useful pages
+        self._advise("MADV_RANDOM", "POSIX_FADV_RANDOM")
         self._read_only = True
 
+    def _map(self, access: int):
+        """
+        maps the open file, whole or as a segmented window when it is too large to map at once
+
+        Args:
+            access: mmap.ACCESS_WRITE or mmap.ACCESS_READ
+
+        Returns:
+            an mmap.mmap, or a _SegmentedMap for torrents over MMAP_WINDOW_THRESHOLD
+        """
+        length = self.torrent_file.total_length
+        if length > MMAP_WINDOW_THRESHOLD:
+            return _SegmentedMap(self._fd.fileno(), length, access)
+        return mmap.mmap(self._fd.fileno(), length, access=access)
+
+    def _advise(self, madvice: str, fadvice: str) -> None:
+        """
+        hints the kernel about the upcoming access pattern, where the platform supports it
+
+        Args:
+            madvice: name of the mmap.MADV_* constant for the mapping
+            fadvice: name of the os.POSIX_FADV_* constant for the file
+        """
+        if hasattr(mmap, madvice):
+            try:
+                self._mmap.madvise(getattr(mmap, madvice))
+            except OSError:
+                pass
+
+        if hasattr(os, "posix_fadvise") and hasattr(os, fadvice):
+            try:
+                os.posix_fadvise(self._fd.fileno(), 0, self.torrent_file.total_length, getattr(os, fadvice))
+            except OSError:
+                pass
+
     def cleanup(self):
         """
         Called when the torrent is removed / program exits
@@ -128,7 +310,6 @@ class PieceStorage:
         takes .part file and scatters bytes into corresponding target files
         """
         global_off = 0
-        piece_length = self.torrent_file.piece_length
 
         with open(self.part_path, "rb") as src:
 
@@ -139,11 +320,69 @@ class PieceStorage:
 
                 # create target writing file
                 with open(full_path, "wb") as dst:
-                    remaining = file_len  # number of bytes that belong to this file
-                    while remaining:
-                        # read from .part file up to piece size or remaining length
-                        piece = src.read(min(remaining, piece_length))
-                        dst.write(piece)
-
-                        remaining -= len(piece)
-                        global_off += len(piece)
+                    _copy_range(src.fileno(), dst.fileno(), global_off, file_len)
+
+                global_off += file_len
+
+
+def _preallocate(fd: int, length: int) -> None:
+    """
+    sizes a new file to length, reserving its extents up front where the platform supports it
+    so later writes don't allocate blocks one at a time and fragment the file
+
+    Args:
+        fd: file descriptor of the file, opened for writing
+        length: size in bytes to reserve
+    """
+    if length > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError:
+            pass  # e.g. not supported by this filesystem, fall back to a sparse file
+
+    os.ftruncate(fd, length)
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, length: int) -> None:
+    """
+    copies length bytes starting at offset in src to the start of dst, in the kernel where possible:
+    copy_file_range (linux), then sendfile, then a plain read / write loop
+
+    Args:
+        src_fd: source file descriptor
+        dst_fd: destination file descriptor, written from its start
+        offset: offset in the source to copy from
+        length: number of bytes to copy
+    """
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied, offset + copied, copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass  # e.g. not supported by this filesystem or kernel, continue below
+
+    if copied < length and hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst_fd, copied, os.SEEK_SET)
+            while copied < length:
+                n = os.sendfile(dst_fd, src_fd, offset + copied, length - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            pass
+
+    if copied < length:
+        os.lseek(dst_fd, copied, os.SEEK_SET)
+        while copied < length:
+            chunk = os.pread(src_fd, min(length - copied, COPY_CHUNK_SIZE), offset + copied)
+            if not chunk:
+                break
+            os.write(dst_fd, chunk)
+            copied += len(chunk)
@@ -1,14 +1,18 @@
-import hashlib
-import random
+import functools
+import logging
+import os
+import secrets
 import selectors
 import struct
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from typing import Optional
 
 import bitarray
 
+from .hashing import sha1_digest
 from .peer_connection import PeerConnection
 from .peer_manager import PeerManager
 from .piece_manager import PieceManager
@@ -16,11 +20,27 @@ from .storage_manager import PieceStorage
 from .torrent_file import TorrentFile
 from .tracker_manager import TrackerManager
 
+logger = logging.getLogger(__name__)
+
+TICK_INTERVAL = 1.0  # seconds between request timeout sweeps in the event loop
+
+# message payload layouts, compiled once instead of parsing the format string per message
+_U32 = struct.Struct(">I").unpack_from  # have: index
+_U32_2 = struct.Struct(">II").unpack_from  # piece: index, begin
+_U32_3 = struct.Struct(">III").unpack_from  # request: index, begin, length
+
+
+@functools.lru_cache(maxsize=1024)
+def format_timestamp(timestamp: Optional[float]) -> Optional[str]:
+    """formats a unix timestamp for display in local time, None if unset"""
+    if not timestamp:
+        return None
+    return time.strftime('%Y-%m-%d %H:%M:%S %Z', time.localtime(timestamp))
+
 
 def _generate_peer_id() -> str:
     """generates a random peer id string"""
-    return "-PC0001-" + ''.join(random.choice("0123456789abcdef")
-                                for _ in range(12))
+    return "-PC0001-" + secrets.token_hex(6)
 
 
 class TorrentClient:
@@ -39,6 +59,11 @@ class TorrentClient:
         num_pieces: total number of pieces in the torrent
         paused: True if the torrent is paused
         _paused_cond: condition variable to control pause/resume
+        added_on: timestamp when the torrent was added
+        completed_on: timestamp when the download finished
+        added_on_str: added_on formatted for display
+        completed_on_str: completed_on formatted for display
+        version: incremented on pause / resume and on every message handled from a peer
     """
 
     def __init__(self, torrent_path: str, peer_id: Optional[str] = None, download_dir: str = ".",
@@ -76,7 +101,7 @@ class TorrentClient:
         # verify existing download
         if was_finished:
             for piece in self.piece_manager.pieces:
-                piece.is_complete = True
+                self.piece_manager.mark_complete(piece.index)
             self.piece_manager.downloaded_bytes = self.torrent_file.total_length
 
         else:
@@ -87,14 +112,34 @@ class TorrentClient:
         self.paused: bool = False
         self._paused_cond = threading.Condition()
 
+        self.version: int = 0
+
         self.start_time: float = time.time()
 
         self._announce_worker_stop = threading.Event()
 
-        # bookkeeping
+        # bookkeeping, setting these also refreshes the *_str display strings
         self.added_on: float | None = None
         self.completed_on: float | None = None  # filled when piece manager is finished
 
+    @property
+    def added_on(self) -> Optional[float]:
+        return self._added_on
+
+    @added_on.setter
+    def added_on(self, value: Optional[float]) -> None:
+        self._added_on = value
+        self.added_on_str: Optional[str] = format_timestamp(value)
+
+    @property
+    def completed_on(self) -> Optional[float]:
+        return self._completed_on
+
+    @completed_on.setter
+    def completed_on(self, value: Optional[float]) -> None:
+        self._completed_on = value
+        self.completed_on_str: Optional[str] = format_timestamp(value)
+
     def download(self) -> None:
         """starts main download"""
 
@@ -110,10 +155,11 @@ class TorrentClient:
     def pause(self) -> None:
         """pauses the download"""
         for peer in self.peer_manager.peers:
-            peer.rates.clear()
+            peer.clear_samples()
 
         with self._paused_cond:
             self.paused = True
+            self.version += 1
 
     def resume(self) -> None:
         """resumes the download"""
@@ -123,8 +169,19 @@ class TorrentClient:
 
         with self._paused_cond:
             self.paused = False
+            self.version += 1
             self._paused_cond.notify_all()
 
+    def status_version(self) -> tuple:
+        """
+        versions of everything rendered by /status, changes whenever any of it is mutated
+
+        Returns:
+            tuple of this client's identity and its component versions
+        """
+        return (id(self), self.version, self.piece_manager.version, self.tracker_manager.version,
+                self.peer_manager.version if self.peer_manager else None)
+
     def start_auto_announce_worker(self):
         threading.Thread(target=self._auto_announce_loop, daemon=True).start()
 
@@ -136,11 +193,10 @@ class TorrentClient:
                     try:
                         peers, interval = tracker.client.get_peers(event="")
                         tracker.interval = interval
-                        tracker.next_announce = now + interval
+                        self.tracker_manager.update_next_announce(tracker, now + interval)
 
                         # Add new peers to PeerManager
-                        known_ips = {p.ip for p in self.peer_manager.peers}
-                        fresh_peers = [p for p in peers if p.ip not in known_ips]
+                        fresh_peers = self.peer_manager.unknown_peers(peers)
 
                         if fresh_peers:
                             new_peer_manager = PeerManager(fresh_peers, self.torrent_file, self.piece_manager)
@@ -164,8 +220,7 @@ class TorrentClient:
 
         try:
             new_peers, _ = self.tracker_manager.get_all_peers(event=event)
-            known_peer_ips = {peer.ip for peer in self.peer_manager.peers}
-            fresh_peers = [p for p in new_peers if p.ip not in known_peer_ips]
+            fresh_peers = self.peer_manager.unknown_peers(new_peers)
 
             if fresh_peers:
                 new_peer_manager = PeerManager(fresh_peers, self.torrent_file, self.piece_manager)
@@ -198,12 +253,17 @@ class TorrentClient:
                 peer.send_bitfield(bitfield)
 
     def _event_loop(self):
+        next_tick = 0.0
         while not self.piece_manager.is_finished():
             with self._paused_cond:
                 while self.paused:
                     self._paused_cond.wait()
 
-            self.piece_manager.tick()
+            # timeouts are whole seconds, so sweeping on every wake-up would only repeat work
+            now = time.monotonic()
+            if now >= next_tick:
+                self.piece_manager.tick()
+                next_tick = now + TICK_INTERVAL
 
             if not self.select.get_map():
                 # no active peers
@@ -214,94 +274,142 @@ class TorrentClient:
             if not events:
                 continue
 
-            for key, _ in events:
+            for key, mask in events:
                 peer: PeerConnection = key.data
                 if not peer.active:
                     continue
 
-                try:
-                    msg = peer.recv_message()
-                except (ConnectionError, OSError) as e:
-                    print(f"[{peer.ip}:{peer.port}] disconnected")
-                    self.peer_manager.remove_peer(peer)
-                    self.select.unregister(peer.sock)
+                if mask & selectors.EVENT_READ:
+                    try:
+                        messages = peer.recv_messages()
+                    except (ConnectionError, OSError) as e:
+                        logger.debug("[%s:%s] disconnected: %s", peer.ip, peer.port, e)
+                        self.peer_manager.remove_peer(peer)
+                        self.select.unregister(peer.sock)
 
-                    continue
+                        continue
 
-                if msg is None:
-                    continue
+                    for msg in messages:
+                        self.version += 1
+                        self._handle_message(peer, msg)
 
-                if msg["type"] == "timeout" or msg["type"] == "keep-alive":
-                    continue
+                # one send covers output left over from a write-ready event and anything queued above
+                self._flush_peer(peer)
+
+    def _handle_message(self, peer: PeerConnection, msg: dict) -> None:
+        """
+        reacts to one message received from a peer
+
+        Args:
+            peer: peer the message came from
+            msg: parsed message, see PeerConnection.recv_message
+        """
+        if msg["type"] == "timeout" or msg["type"] == "keep-alive":
+            return
+
+        # one indexed lookup instead of comparing the id against every message type in turn
+        message_id = msg["id"]
+        if message_id < len(self._HANDLERS):
+            self._HANDLERS[message_id](self, peer, msg["payload"])
+
+        if (not peer.choked) and peer.bitmap:
+            # top the pipeline up in one selection pass, the requests leave together on the next flush
+            for block in self.piece_manager.next_requests_rarest_first(peer.bitmap, peer.free_slots, peer):
+                peer.send_request(block.piece_index, block.offset, block.length)
+
+    def _on_choke(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer stopped serving our requests"""
+        peer.choked = True
+        # the peer drops our pending requests, so hand its blocks to other peers right away
+        self.piece_manager.on_choke(peer)
+
+    def _on_unchoke(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer will serve our requests again"""
+        peer.choked = False
+
+    def _on_interested(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer wants pieces from us, unchoke it"""
+        peer.remote_interested = True
+        if peer.remote_choked:
+            peer.send_unchoke()
+
+    def _on_not_interested(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer no longer wants pieces from us, choke it"""
+        peer.remote_interested = False
+        if not peer.remote_choked:
+            peer.send_choke()
+            peer.remote_choked = True
+
+    def _on_have(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer announced one new piece"""
+        piece_index = _U32(payload)[0]
+        peer.ensure_bitmap(self.num_pieces)
+        if 0 <= piece_index < self.num_pieces and peer.mark_have(piece_index):
+            self.piece_manager.add_have(piece_index)
+
+    def _on_bitfield(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer announced every piece it has"""
+        if peer.bitmap is not None:
+            # replaces whatever this peer announced before
+            self.piece_manager.peer_disconnect(peer.bitmap)
+        peer.set_bitfield(payload, self.num_pieces)
+        self.piece_manager.add_bitmap(peer.bitmap)
+
+    def _on_request(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer asked for a block, served if we have the piece and it isn't choked"""
+        index, start, length = _U32_3(payload)
+        if peer.remote_choked or not 0 <= index < self.num_pieces:
+            return
+
+        piece = self.piece_manager.pieces[index]
+        if piece.is_complete and start + length <= piece.length:
+            peer.send_piece_from(index, start, self.piece_storage, piece.base_offset + start, length)
+
+    def _on_piece(self, peer: PeerConnection, payload: memoryview) -> None:
+        """peer sent a block we requested"""
+        index, begin = _U32_2(payload)
+        block = payload[8:]  # zero-copy view, written to storage and hashed as-is
+        peer.record_download(len(block))
+
+        completed = self.piece_manager.block_received(index, begin, block)
+        if completed:
+            for p in self.peer_manager.peers:
+                if p.active:
+                    p.send_have(index)
+                    if p is not peer:
+                        self._flush_peer(p)
+                    # the sending peer is flushed by the event loop, with its next requests in the same send
+
+            if self.piece_manager.is_finished():
+                self.piece_storage.switch_to_seeding()
+                if self.completed_on is None:
+                    self.completed_on = time.time()
+
+    # indexed by message id, ids past the end (extensions) are ignored
+    _HANDLERS = (_on_choke, _on_unchoke, _on_interested, _on_not_interested,
+                 _on_have, _on_bitfield, _on_request, _on_piece)
+
+    def _flush_peer(self, peer: PeerConnection) -> None:
+        """
+        sends a peer's queued output in one go, and watches its socket for writability
+        only while some of it is still left over
+        """
+        peer.flush()
+
+        events = selectors.EVENT_READ
+        if peer.wants_write:
+            events |= selectors.EVENT_WRITE
 
-                message_id = msg["id"]
-                payload = msg["payload"]
-
-                if message_id == 0:
-                    peer.choked = True
-
-                elif message_id == 1:
-                    peer.choked = False
-
-                elif message_id == 2:
-                    peer.remote_interested = True
-                    if peer.remote_choked:
-                        peer.send_unchoke()
-
-                elif message_id == 3:
-                    peer.remote_interested = False
-                    if not peer.remote_choked:
-                        peer.send_choke()
-                        peer.remote_choked = True
-
-                elif message_id == 4:
-                    piece_index = struct.unpack(">I", payload)[0]
-                    peer.ensure_bitmap(self.num_pieces)
-                    peer.bitmap[piece_index] = 1
-
-                elif message_id == 5:
-                    peer.bitmap = bitarray.bitarray()
-                    peer.bitmap.frombytes(payload)
-                    peer.ensure_bitmap(self.num_pieces)
-
-                elif message_id == 6:
-                    index, start, length = struct.unpack(">III", payload)
-                    if (not peer.remote_choked and
-                            0 <= index < self.num_pieces and
-                            self.piece_manager.pieces[index].is_complete):
-                        global_off = index * self.torrent_file.piece_length + start
-                        block = self.piece_storage.read(global_off, length)
-                        peer.send_piece(index, start, block)
-                        peer.record_upload(len(block))
-
-                elif message_id == 7:
-
-                    index = struct.unpack(">I", payload[:4])[0]
-                    begin = struct.unpack(">I", payload[4:8])[0]
-                    block = payload[8:]
-                    peer.record_download(len(block))
-
-                    completed = self.piece_manager.block_received(index, begin, block)
-                    if completed:
-                        for p in self.peer_manager.peers:
-                            if p.active:
-                                p.send_have(index)
-
-                        if self.piece_manager.is_finished():
-                            self.piece_storage.switch_to_seeding()
-                            if self.completed_on is None:
-                                self.completed_on = time.time()
-
-                if (not peer.choked) and peer.bitmap:
-                    block = self.piece_manager.next_request_rarest_first(peer.bitmap)
-                    if block:
-                        peer.send_request(block.piece_index, block.offset, block.length)
-
-    def _generate_bitfield(self) -> bitarray:
+        try:
+            if self.select.get_key(peer.sock).events != events:
+                self.select.modify(peer.sock, events, data=peer)
+        except (KeyError, ValueError):
+            pass  # socket no longer registered
+
+    def _generate_bitfield(self) -> bytes:
         """creates our clients bitfield"""
-        bits = bitarray.bitarray(len(self.piece_manager.pieces))
-        for piece in self.piece_manager.pieces:
-            bits[piece.index] = piece.is_complete
+        # pieces are in index order, bitarray consumes the flags in C instead of one subscript per bit
+        bits = bitarray.bitarray((piece.is_complete for piece in self.piece_manager.pieces), endian="big")
         return bits.tobytes()
 
     def _verify_existing(self) -> None:
@@ -309,24 +417,24 @@ class TorrentClient:
         checks disk pieces to see which are already completed, appropriately
         marks pieces and blocks in the piece manager
         """
+        pieces = self.piece_manager.pieces
+        storage = self.piece_storage
+
+        def piece_digest(piece):
+            # hashed straight out of the mapping, the view is dropped before seeding remaps it
+            return sha1_digest(storage.view(piece.base_offset, piece.length))
 
+        # hashlib drops the GIL while hashing, so pieces are hashed on every core at once,
+        # and completion is recorded back on this thread
+        workers = (os.cpu_count() or 1) if storage.concurrent_reads else 1
         verified_count = 0
 
-        for piece in self.piece_manager.pieces:
-            start = piece.index * self.torrent_file.piece_length
-            end = start + piece.length
-            data = self.piece_storage.read(start, end - start)
-
-            actual_hash = hashlib.sha1(data, usedforsecurity=False).digest()
-            expected_hash = piece.sha1
-
-            if actual_hash == expected_hash:
-                piece.is_complete = True
-                for block in piece.blocks:
-                    block.is_received = True
-                    block.data = None
-                self.piece_manager.downloaded_bytes += piece.length
-                verified_count += 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for piece, actual_hash in zip(pieces, pool.map(piece_digest, pieces)):
+                if actual_hash == piece.sha1:
+                    self.piece_manager.mark_complete(piece.index)
+                    self.piece_manager.downloaded_bytes += piece.length
+                    verified_count += 1
 
         print(f"[verify] Verified {verified_count}/{len(self.piece_manager.pieces)} pieces")
 
@@ -1,9 +1,14 @@
-import hashlib
 from typing import List, Optional, Dict, Generator, Tuple
 
-import bencodepy
-
 from .bencode import Bencode
+from .hashing import sha1_digest
+
+
+def _as_text(value) -> Optional[str]:
+    """returns an optional decoded string field as str, decoding leftover bytes leniently"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='ignore')
+    return value
 
 
 class TorrentFile:
@@ -23,6 +28,8 @@ class TorrentFile:
         total_length: total length of all files combined
         files: list of file dictionaries, each has 'length' and 'path'
         is_multifile: True if torrent contains multiple files, false otherwise
+        comment: optional free-form comment
+        creation_date: optional creation time as a unix timestamp
     """
 
     def __init__(self, path):
@@ -49,6 +56,9 @@ class TorrentFile:
 
         self.announce_list: Optional[List[List[str]]] = None
 
+        self.comment: Optional[str] = None
+        self.creation_date: Optional[int] = None
+
     def parse(self):
         """
         parses the .torrent file and populates class attributes
@@ -67,8 +77,9 @@ class TorrentFile:
         self.piece_length = self.info['piece length']
         self.pieces = self.info['pieces']
 
-        bencoded_info = bencodepy.encode(self.info)
-        self.info_hash = hashlib.sha1(bencoded_info, usedforsecurity=False).digest()
+        # hash the info dict exactly as it appears in the file
+        info_start, info_end = Bencode.find_info_slice(self.raw_data)
+        self.info_hash = sha1_digest(memoryview(self.raw_data)[info_start:info_end])
 
         if "files" in self.info:
             self.is_multifile = True
@@ -83,6 +94,10 @@ class TorrentFile:
         if 'announce-list' in self.metadata:
             self.announce_list = self.metadata['announce-list']
 
+        self.comment = _as_text(self.metadata.get('comment'))
+        creation_date = self.metadata.get('creation date')
+        self.creation_date = creation_date if isinstance(creation_date, int) else None
+
     def file_layout(self) -> Generator[Tuple[List[str], int, int], None, None]:
         """
         return iterable of tuples
@@ -1,12 +1,14 @@
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Tuple
+from typing import List, Tuple, Optional
 
 from .http_tracker_client import HTTPTrackerClient
 from .peer_connection import PeerConnection
 from .torrent_file import TorrentFile
 from .udp_tracker_client import UDPTrackerClient
 
+MAX_ANNOUNCE_WORKERS = 32  # trackers announced to at once, matches the shared http connection pool
+
 
 class TrackerEntry:
     def __init__(self, client):
@@ -27,11 +29,14 @@ class TrackerManager:
     Attributes:
         torrent_file: the parsed TorrentFile object
         trackers: list of all trackers
+        min_next_announce: earliest next_announce across trackers, None if there are no trackers
+        version: incremented whenever a tracker's state changes
     """
 
     def __init__(self, torrent_file: TorrentFile, peer_id: str, port=6881):
 
         self.torrent_file = torrent_file
+        self.version = 0
 
         self.trackers: List[TrackerEntry] = []
 
@@ -54,14 +59,30 @@ class TrackerManager:
                     continue
                 self.trackers.append(TrackerEntry(client))
 
+        self.min_next_announce: Optional[float] = min((t.next_announce for t in self.trackers), default=None)
+
+    def update_next_announce(self, tracker: TrackerEntry, next_announce: float) -> None:
+        """
+        sets a tracker's next announce time and refreshes min_next_announce
+
+        Args:
+            tracker: the tracker entry to update
+            next_announce: timestamp of its next announce
+        """
+        tracker.next_announce = next_announce
+        self.min_next_announce = min(t.next_announce for t in self.trackers)
+        self.version += 1
+
     def get_all_peers(self, event: str = "") -> Tuple[List[PeerConnection], int]:
         all_peers = []
         seen = set()
         min_interval = 1800  # fallback interval
+        num_pieces = len(self.torrent_file.pieces) // 20
 
         print(f"[get_all_peers] Announcing to {len(self.trackers)} trackers with event='{event}'")
 
-        with ThreadPoolExecutor(max_workers=min(10, len(self.trackers))) as pool:
+        # every tracker is asked at once, so an announce takes as long as the slowest tracker, not the sum
+        with ThreadPoolExecutor(max_workers=max(1, min(MAX_ANNOUNCE_WORKERS, len(self.trackers)))) as pool:
             futures = {pool.submit(tracker.client.get_peers, event): tracker for tracker in self.trackers}
 
             for future in as_completed(futures):
@@ -70,8 +91,9 @@ class TrackerManager:
                     peers, interval = future.result()
                     tracker.last_status = "working"
                     tracker.last_msg = None
+                    # have_count is kept up to date by the peer, no bitmap popcount per peer per announce
                     tracker.last_seeds = sum(
-                        1 for p in peers if p.bitmap and p.bitmap.count(1) == len(self.torrent_file.pieces)
+                        1 for p in peers if p.bitmap is not None and p.have_count == num_pieces
                     )
                     tracker.last_peers = len(peers) - tracker.last_seeds
 
@@ -84,4 +106,6 @@ class TrackerManager:
                     print(f"[tracker] Failed to get peers from {tracker.client.tracker_url}: {e}")
                     tracker.last_status = "error"
                     tracker.last_msg = str(e)
+
+        self.version += 1
         return all_peers, min_interval
@@ -1,13 +1,21 @@
 import random
 import socket
 import struct
-from typing import List, Tuple
+import time
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
-from .peer_connection import PeerConnection
+from .peer_connection import PeerConnection, peers_from_compact
 from .torrent_file import TorrentFile
 
 MAGIC_CONSTANT = 0x41727101980
+CONNECTION_ID_TTL = 60  # seconds a tracker accepts a connection id for (BEP 15)
+
+# packet layouts from BEP 15, compiled once
+_CONNECT_REQUEST = struct.Struct(">QLL")  # protocol id, action, transaction id
+_CONNECT_RESPONSE = struct.Struct(">LLQ")  # action, transaction id, connection id
+_ANNOUNCE_REQUEST = struct.Struct(">QLL20s20sQQQLLLLH")
+_ANNOUNCE_HEADER = struct.Struct(">LLLLL")  # action, transaction id, interval, leechers, seeders
 
 
 def _generate_transaction_id():
@@ -42,6 +50,10 @@ class UDPTrackerClient:
 
         self.event_map = {'completed': 1, 'started': 2, 'stopped': 3}
 
+        # reused by announces within CONNECTION_ID_TTL, saving the connect round trip
+        self._connection_id: Optional[int] = None
+        self._connection_expires: float = 0.0
+
     def get_peers(self, event: str) -> Tuple[List[PeerConnection], int]:
         """
         retrieve list of peers from tracker
@@ -65,23 +77,61 @@ class UDPTrackerClient:
         port = parsed.port
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(3)
+        try:
+            sock.settimeout(3)
+            return self._announce(sock, (host, port), event)
+        finally:
+            sock.close()
 
-        action = 0
+    def _connect(self, sock: socket.socket, address: Tuple[str, int]) -> int:
+        """
+        obtains a connection id from the tracker, or reuses the last one while it is valid
+
+        Args:
+            sock: udp socket to talk to the tracker on
+            address: tracker (host, port)
+
+        Returns:
+            the connection id
+
+        Raises:
+            Exception: tracker replied with another transaction id
+        """
+        now = time.monotonic()
+        if self._connection_id is not None and now < self._connection_expires:
+            return self._connection_id
 
-        payload = struct.pack(">QLL", MAGIC_CONSTANT, action, self.transaction_id)
+        action = 0
 
-        sock.sendto(payload, (host, port))
+        payload = _CONNECT_REQUEST.pack(MAGIC_CONSTANT, action, self.transaction_id)
 
-        # print(f"sending to {host}, {port}")
+        sock.sendto(payload, address)
 
         data = sock.recv(16)
-        # print(data)
 
-        action, transaction_id, connection_id = struct.unpack(">LLQ", data)
+        action, transaction_id, connection_id = _CONNECT_RESPONSE.unpack(data)
         if transaction_id != self.transaction_id:
             raise Exception("transaction id mismatch")
 
+        self._connection_id = connection_id
+        self._connection_expires = now + CONNECTION_ID_TTL
+        return connection_id
+
+    def _announce(self, sock: socket.socket, address: Tuple[str, int],
+                  event: str) -> Tuple[List[PeerConnection], int]:
+        """
+        sends the announce request and parses the tracker's reply
+
+        Args:
+            sock: udp socket to talk to the tracker on
+            address: tracker (host, port)
+            event: a string representing the tracker event
+
+        Returns:
+            list of PeerConnections and the announce interval
+        """
+        connection_id = self._connect(sock, address)
+
         # announce req
 
         action = 1
@@ -93,21 +143,15 @@ class UDPTrackerClient:
         key = random.randint(0, 0xFFFFFFFF)
         num_want = 0xFFFFFFFF
 
-        payload = struct.pack(">QLL20s20sQQQLLLLH", connection_id, action, self.transaction_id,
-                              self.torrent_file.info_hash, self.peer_id.encode(), downloaded, left, uploaded,
-                              event, ip, key, num_want, self.port)
+        payload = _ANNOUNCE_REQUEST.pack(connection_id, action, self.transaction_id,
+                                         self.torrent_file.info_hash, self.peer_id.encode(), downloaded, left,
+                                         uploaded, event, ip, key, num_want, self.port)
 
-        sock.sendto(payload, (host, port))
+        sock.sendto(payload, address)
 
         data, _ = sock.recvfrom(4096)
 
-        action, transaction_id, interval, num_leechers, num_seeders = struct.unpack(">LLLLL", data[:20])
-        peer_data = data[20:]
-
-        peers = []
-        for i in range(0, len(peer_data), 6):
-            ip = socket.inet_ntoa(peer_data[i:i + 4])
-            port = struct.unpack(">H", peer_data[i + 4:i + 6])[0]
-            peers.append(PeerConnection(ip, port, self.peer_id))
+        action, transaction_id, interval, num_leechers, num_seeders = _ANNOUNCE_HEADER.unpack_from(data)
+        peers = peers_from_compact(memoryview(data)[_ANNOUNCE_HEADER.size:], self.peer_id)
 
         return peers, interval
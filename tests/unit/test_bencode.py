@@ -59,3 +59,45 @@ class TestBencodeDecode(unittest.TestCase):
     def test_incomplete_dict(self):
         with self.assertRaises(ValueError):
             Bencode.bencode_decode(b'd3:key4:val')
+
+    def test_deeply_nested_list(self):
+        depth = 5000
+        data = b'l' * depth + b'i1e' + b'e' * depth
+        value = Bencode.bencode_decode(data)
+        for _ in range(depth):
+            value = value[0]
+        self.assertEqual(value, 1)
+
+    def test_dict_key_without_value(self):
+        with self.assertRaises(ValueError):
+            Bencode.bencode_decode(b'd3:keye')
+
+
+class TestFindInfoSlice(unittest.TestCase):
+    def test_finds_info_dict(self):
+        data = b'd8:announce3:url4:infod4:name1:a6:lengthi5eee'
+        start, end = Bencode.find_info_slice(data)
+        self.assertEqual(data[start:end], b'd4:name1:a6:lengthi5ee')
+
+    def test_skips_nested_values_before_info(self):
+        data = b'd4:listl1:xd4:infoi1eee4:infod1:ki2eee'
+        start, end = Bencode.find_info_slice(data)
+        self.assertEqual(data[start:end], b'd1:ki2ee')
+
+    def test_missing_info_raises(self):
+        with self.assertRaises(ValueError):
+            Bencode.find_info_slice(b'd8:announce3:urle')
+
+    def test_not_a_dict_raises(self):
+        with self.assertRaises(ValueError):
+            Bencode.find_info_slice(b'l4:infoe')
+
+
+class TestDecodeRaw(unittest.TestCase):
+    def test_keeps_bytes(self):
+        value = Bencode.decode_raw(b'd4:infod4:name1:aee')
+        self.assertEqual(value, {b'info': {b'name': b'a'}})
+
+    def test_accepts_unsorted_keys(self):
+        value = Bencode.decode_raw(b'd4:name1:a6:lengthi5ee')
+        self.assertEqual(value, {b'name': b'a', b'length': 5})
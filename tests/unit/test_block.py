@@ -23,3 +23,8 @@ class TestBlock(unittest.TestCase):
         self.assertFalse(block.is_requested)
         self.assertFalse(block.is_received)
         self.assertIsNone(block.request_time)
+
+    def test_slots_reject_unknown_attributes(self):
+        block = Block(0, 0, 16384)
+        with self.assertRaises(AttributeError):
+            block.data = b"x"
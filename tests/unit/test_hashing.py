@@ -0,0 +1,19 @@
+import hashlib
+import unittest
+
+from src.hashing import sha1_digest, sha1_hasher
+
+
+class TestSha1Digest(unittest.TestCase):
+    def test_matches_hashlib(self):
+        self.assertEqual(sha1_digest(b"abc"), hashlib.sha1(b"abc").digest())
+
+    def test_accepts_memoryview_slice(self):
+        data = b"xxabcxx"
+        self.assertEqual(sha1_digest(memoryview(data)[2:5]), hashlib.sha1(b"abc").digest())
+
+    def test_hasher_is_incremental(self):
+        hasher = sha1_hasher()
+        hasher.update(b"a")
+        hasher.update(b"bc")
+        self.assertEqual(hasher.digest(), sha1_digest(b"abc"))
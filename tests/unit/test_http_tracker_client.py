@@ -2,6 +2,7 @@ import hashlib
 import unittest
 from unittest.mock import patch, MagicMock
 
+from src import http_tracker_client
 from src.http_tracker_client import HTTPTrackerClient, percent_encode_bytes
 from src.peer_connection import PeerConnection
 
@@ -10,6 +11,7 @@ class DummyTorrentFile:
     def __init__(self):
         self.info = {'name': 'testfile', 'length': 1000, 'piece length': 512, 'pieces': b'abc'}
         self.total_length = 1000
+        self.info_hash = hashlib.sha1(b"info").digest()
 
 
 class TestHTTPTrackerClient(unittest.TestCase):
@@ -23,20 +25,13 @@ class TestHTTPTrackerClient(unittest.TestCase):
         result = percent_encode_bytes(b"abc")
         self.assertEqual(result, "%61%62%63")
 
-    @patch("src.http_tracker_client.requests.get")
-    @patch("src.http_tracker_client.bencodepy.decode")
-    @patch("src.http_tracker_client.bencodepy.encode")
-    def test_get_peers_success(self, mock_encode, mock_decode, mock_get):
-        mock_encode.return_value = b"bencoded"
+    @patch("src.http_tracker_client._session.get")
+    def test_get_peers_success(self, mock_get):
         peers_binary = b"\x7f\x00\x00\x01\x1a\xe1"  # 127.0.0.1:6881
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_response.content = b"mocked"
+        mock_response.content = b"d8:intervali1800e5:peers6:" + peers_binary + b"e"
         mock_get.return_value = mock_response
-        mock_decode.return_value = {
-            b"interval": 1800,
-            b"peers": peers_binary
-        }
 
         peers, interval = self.client.get_peers("started")
 
@@ -46,10 +41,8 @@ class TestHTTPTrackerClient(unittest.TestCase):
         self.assertEqual(peers[0].ip, "127.0.0.1")
         self.assertEqual(peers[0].port, 6881)
 
-    @patch("src.http_tracker_client.requests.get")
-    @patch("src.http_tracker_client.bencodepy.encode")
-    def test_get_peers_failure(self, mock_encode, mock_get):
-        mock_encode.return_value = b"bencoded"
+    @patch("src.http_tracker_client._session.get")
+    def test_get_peers_failure(self, mock_get):
         mock_response = MagicMock()
         mock_response.status_code = 500
         mock_get.return_value = mock_response
@@ -59,10 +52,39 @@ class TestHTTPTrackerClient(unittest.TestCase):
 
         self.assertIn("tracker error", str(context.exception))
 
+    def test_session_is_shared(self):
+        other = HTTPTrackerClient(self.torrent_file, self.peer_id, "https://other.example.com/announce")
+        with patch.object(http_tracker_client._session, "get") as mock_get:
+            mock_get.return_value.status_code = 500
+            for client in (self.client, other):
+                with self.assertRaises(Exception):
+                    client.get_peers("started")
+        self.assertEqual(mock_get.call_count, 2)
+
     def test_build_url(self):
-        info_hash = hashlib.sha1(b"info").digest()
-        url = self.client._build_url(info_hash, "started")
-        self.assertIn("info_hash=", url)
+        url = self.client._build_url("started")
+        self.assertIn("info_hash=" + percent_encode_bytes(hashlib.sha1(b"info").digest()), url)
         self.assertIn("peer_id=-PC0001-abcdefghijklm", url)
         self.assertIn("event=started", url)
         self.assertTrue(url.startswith("http://tracker.example.com/announce?"))
+
+    def test_build_url_query(self):
+        url = self.client._build_url("completed")
+        query = dict(param.split("=", 1) for param in url.split("?", 1)[1].split("&"))
+        self.assertEqual(query, {
+            "info_hash": percent_encode_bytes(self.torrent_file.info_hash),
+            "peer_id": self.peer_id,
+            "port": "6881",
+            "compact": "1",
+            "uploaded": "0",
+            "downloaded": "0",
+            "left": "1000",
+            "event": "completed",
+        })
+
+    def test_info_hash_encoded_once(self):
+        with patch("src.http_tracker_client.percent_encode_bytes", wraps=percent_encode_bytes) as encode:
+            first = self.client._build_url("started")
+            second = self.client._build_url(None)
+        encode.assert_called_once_with(self.torrent_file.info_hash)
+        self.assertEqual(first.split("&")[0], second.split("&")[0])
@@ -1,12 +1,16 @@
+import asyncio
 import hashlib
+import os
+import socket
 import struct
+import tempfile
 import time
 import unittest
 from unittest.mock import MagicMock, patch
 
 import bitarray
 
-from src.peer_connection import PeerConnection, PROTOCOL_STRING, HANDSHAKE_LEN
+from src.peer_connection import PeerConnection, peers_from_compact, PROTOCOL_STRING, HANDSHAKE_LEN, MAX_INFLIGHT, RECV_SIZE, SOCK_BUFFER_SIZE
 
 
 class TestPeerConnection(unittest.TestCase):
@@ -31,6 +35,34 @@ class TestPeerConnection(unittest.TestCase):
         pc.connect(self.info_hash)
         self.assertTrue(pc.active)
         self.assertEqual(pc.remote_id, self.peer_id)
+        mock_sock.setsockopt.assert_any_call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        mock_sock.setsockopt.assert_any_call(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUFFER_SIZE)
+
+    def test_connect_async(self):
+        async def run(reply):
+            async def handle(reader, writer):
+                await reader.readexactly(HANDSHAKE_LEN)
+                writer.write(reply)
+                await writer.drain()
+                writer.close()
+
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            pc = PeerConnection("127.0.0.1", port, self.peer_id)
+            try:
+                async with server:
+                    await pc.connect_async(self.info_hash)
+            finally:
+                if pc.sock:
+                    pc.sock.close()
+            return pc
+
+        pc = asyncio.run(run(self.fake_handshake))
+        self.assertTrue(pc.active)
+        self.assertEqual(pc.remote_id, self.peer_id)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(run(b"\x00" * HANDSHAKE_LEN))
 
     def test_close_socket(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
@@ -75,6 +107,45 @@ class TestPeerConnection(unittest.TestCase):
         self.assertFalse(result)
         self.assertFalse(pc.active)
 
+    def test_safe_send_queues_when_socket_full(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        mock_sock = MagicMock()
+        mock_sock.send.side_effect = [2, BlockingIOError]
+        pc.sock = mock_sock
+        pc.active = True
+
+        self.assertTrue(pc._safe_send(b"hello"))
+        self.assertTrue(pc.active)
+        self.assertTrue(pc.wants_write)
+
+        # later payloads queue behind the pending bytes
+        self.assertTrue(pc._safe_send(b"!"))
+        self.assertEqual(pc._send_buffer, bytearray(b"llo!"))
+
+    def test_flush(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        mock_sock = MagicMock()
+        mock_sock.send.side_effect = [2, 2]
+        pc.sock = mock_sock
+        pc._send_buffer = bytearray(b"abcd")
+
+        self.assertFalse(pc.flush())
+        self.assertEqual(pc._send_buffer, bytearray(b"cd"))
+        self.assertTrue(pc.flush())
+        self.assertFalse(pc.wants_write)
+
+    def test_flush_failure(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        mock_sock = MagicMock()
+        mock_sock.send.side_effect = ConnectionResetError
+        pc.sock = mock_sock
+        pc.active = True
+        pc._send_buffer = bytearray(b"abcd")
+
+        self.assertFalse(pc.flush())
+        self.assertFalse(pc.active)
+        self.assertFalse(pc.wants_write)
+
     def test_validate_handshake_success(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc._validate_handshake(self.fake_handshake, self.info_hash)
@@ -132,6 +203,58 @@ class TestPeerConnection(unittest.TestCase):
         self.assertTrue(pc.send_piece(1, 0, b"abc"))
         self.assertTrue(pc.send_bitfield(b"\xFF"))
 
+    def test_send_piece_from_uses_sendfile(self):
+        data = bytes(range(256)) * 4
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            storage = MagicMock(can_sendfile=True)
+            storage.sendfile.side_effect = lambda out_fd, offset, length: os.sendfile(out_fd, f.fileno(), offset,
+                                                                                      length)
+            a, b = socket.socketpair()
+            with a, b:
+                pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+                pc.sock = a
+                pc.active = True
+
+                self.assertTrue(pc.send_piece_from(3, 16, storage, 100, 500))
+
+                expected = struct.pack(">IBII", 509, 7, 3, 16) + data[100:600]
+                received = b""
+                while len(received) < len(expected):
+                    received += b.recv(4096)
+        self.assertEqual(received, expected)
+        storage.read.assert_not_called()
+        self.assertFalse(pc.wants_write)
+        self.assertEqual(pc.total_uploaded, 500)
+
+    def test_send_piece_from_queues_when_socket_full(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.sock = MagicMock()
+        pc.sock.send.side_effect = lambda b: len(b)
+        pc.active = True
+        storage = MagicMock(can_sendfile=True)
+        storage.sendfile.side_effect = [100, BlockingIOError]
+        storage.read.return_value = b"r" * 400
+
+        self.assertTrue(pc.send_piece_from(0, 0, storage, 1000, 500))
+
+        storage.read.assert_called_once_with(1100, 400)
+        self.assertEqual(bytes(pc._send_buffer), b"r" * 400)
+
+    def test_send_piece_from_behind_queued_output(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.sock = MagicMock()
+        pc.active = True
+        pc._send_buffer += b"pending"
+        storage = MagicMock(can_sendfile=True)
+        storage.read.return_value = b"d" * 4
+
+        self.assertTrue(pc.send_piece_from(1, 0, storage, 0, 4))
+
+        storage.sendfile.assert_not_called()
+        self.assertEqual(bytes(pc._send_buffer), b"pending" + struct.pack(">IBII", 13, 7, 1, 0) + b"d" * 4)
+
     def test_send_request(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.active = True
@@ -140,19 +263,70 @@ class TestPeerConnection(unittest.TestCase):
         self.assertTrue(pc.send_request(1, 0, 1024))
         self.assertEqual(pc._inflight, 1)
 
+    def test_send_wire_format(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.active = True
+        pc.sock = MagicMock()
+        sent = bytearray()
+        pc.sock.send.side_effect = lambda b: sent.extend(b) or len(b)
+
+        pc.send_interested()
+        pc.send_choke()
+        pc.send_unchoke()
+        pc.send_request(1, 2, 3)
+        pc.send_have(7)
+        pc.send_piece(1, 16, b"abc")
+        pc.send_bitfield(b"\xFF")
+        pc.flush()
+
+        self.assertEqual(bytes(sent), b"".join([
+            struct.pack(">IB", 1, 2),
+            struct.pack(">IB", 1, 0),
+            struct.pack(">IB", 1, 1),
+            struct.pack(">IBIII", 13, 6, 1, 2, 3),
+            struct.pack(">IBI", 5, 4, 7),
+            struct.pack(">IBII", 12, 7, 1, 16) + b"abc",
+            struct.pack(">IB", 2, 5) + b"\xFF",
+        ]))
+
+    def test_free_slots(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.active = True
+        pc.sock = MagicMock()
+        self.assertEqual(pc.free_slots, MAX_INFLIGHT)
+        for i in range(MAX_INFLIGHT):
+            pc.send_request(i, 0, 16384)
+        self.assertEqual(pc.free_slots, 0)
+        self.assertFalse(pc.send_request(0, 0, 16384))
+
     def test_send_request_blocked(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.active = False
         result = pc.send_request(1, 0, 1024)
         self.assertFalse(result)
 
-    def test_send_request_safe_send_false(self):
+    def test_send_requests_coalesced(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.active = True
-        pc._inflight = 0
-        pc._safe_send = MagicMock(return_value=False)
-        result = pc.send_request(1, 0, 1024)
-        self.assertFalse(result)
+        pc.sock = MagicMock()
+        sent = []
+        pc.sock.send.side_effect = lambda b: sent.append(bytes(b)) or len(b)
+
+        for i in range(3):
+            self.assertTrue(pc.send_request(i, 0, 16384))
+        pc.sock.send.assert_not_called()
+        self.assertEqual(pc._inflight, 3)
+
+        self.assertTrue(pc.flush())
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0], b"".join(struct.pack(">IBIII", 13, 6, i, 0, 16384) for i in range(3)))
+
+    @staticmethod
+    def _recv_into(data):
+        def recv_into(view):
+            view[:len(data)] = data
+            return len(data)
+        return recv_into
 
     def test_recv_message_piece_and_choke(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
@@ -161,7 +335,7 @@ class TestPeerConnection(unittest.TestCase):
 
         # piece message
         msg = struct.pack(">I", 5) + struct.pack("B", 7) + b"data"
-        pc.sock.recv = MagicMock(return_value=msg)
+        pc.sock.recv_into = self._recv_into(msg)
         pc._recv_buffer = bytearray()
         pc._bytes_needed = None
         result = pc.recv_message()
@@ -169,12 +343,45 @@ class TestPeerConnection(unittest.TestCase):
 
         # choke message
         msg = struct.pack(">I", 1) + struct.pack("B", 0)
-        pc.sock.recv = MagicMock(return_value=msg)
+        pc.sock.recv_into = self._recv_into(msg)
         pc._recv_buffer = bytearray()
         pc._bytes_needed = None
         result = pc.recv_message()
         self.assertEqual(result['id'], 0)
 
+    def test_recv_messages(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.sock = MagicMock()
+        pc.active = True
+        pc._inflight = 2
+
+        msg = struct.pack(">IB", 1, 1) + struct.pack(">IBII", 13, 7, 0, 0) + b"data" + b"\x00\x00"
+        pc.sock.recv_into = self._recv_into(msg)
+        messages = pc.recv_messages()
+
+        self.assertEqual([m["id"] for m in messages], [1, 7])
+        self.assertEqual(pc._inflight, 1)
+
+    def test_recv_messages_drains_full_reads(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.sock = MagicMock()
+        pc.active = True
+
+        block = struct.pack(">IBII", 9 + 16384, 7, 0, 0) + b"x" * 16384
+        stream = block * 5
+        reads = [stream[i:i + RECV_SIZE] for i in range(0, len(stream), RECV_SIZE)]
+
+        def recv_into(view):
+            if not reads:
+                raise BlockingIOError
+            data = reads.pop(0)
+            view[:len(data)] = data
+            return len(data)
+
+        pc.sock.recv_into = recv_into
+        self.assertEqual(len(pc.recv_messages()), 5)
+        self.assertEqual(reads, [])
+
     def test_recv_message_none(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.active = False
@@ -184,7 +391,7 @@ class TestPeerConnection(unittest.TestCase):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.sock = MagicMock()
         pc.active = True
-        pc.sock.recv.side_effect = BlockingIOError
+        pc.sock.recv_into.side_effect = BlockingIOError
 
         pc._parse_one = MagicMock(return_value=None)
         result = pc.recv_message()
@@ -194,11 +401,38 @@ class TestPeerConnection(unittest.TestCase):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.sock = MagicMock()
         pc.active = True
-        pc.sock.recv.return_value = b""
+        pc.sock.recv_into.return_value = 0
 
         with self.assertRaises(ConnectionError):
             pc.recv_message()
 
+    def test_recv_message_reuses_buffer(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.sock = MagicMock()
+        pc.active = True
+        view = pc._recv_view
+
+        # a whole 16 KiB block arrives in one read
+        msg = struct.pack(">IBII", 9 + 16384, 7, 0, 0) + b"x" * 16384
+        pc.sock.recv_into = self._recv_into(msg)
+        result = pc.recv_message()
+
+        self.assertEqual(result["id"], 7)
+        self.assertEqual(len(result["payload"]), 8 + 16384)
+        self.assertIs(pc._recv_view, view)
+
+    def test_parse_one_payload_is_view(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc._recv_buffer = bytearray(struct.pack(">IBII", 13, 7, 1, 0) + b"data" + b"\x00")
+
+        payload = pc._parse_one()["payload"]
+        self.assertIsInstance(payload, memoryview)
+        self.assertEqual(payload[8:], b"data")
+
+        # the buffer can still be resized while the payload is held
+        pc._recv_buffer += b"\x00\x00\x00"
+        self.assertEqual(pc._parse_one(), {"type": "keep-alive"})
+
     def test_parse_one(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc._recv_buffer = bytearray(struct.pack(">I", 0))
@@ -222,18 +456,56 @@ class TestPeerConnection(unittest.TestCase):
         result = pc._parse_one()
         self.assertIsNone(result)
 
+    def test_parse_one_multiple_messages(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc._recv_buffer = bytearray(
+            struct.pack(">IB", 1, 1) + struct.pack(">I", 0) + struct.pack(">IBI", 5, 4, 9) + b"\x00"
+        )
+
+        self.assertEqual(pc._parse_one(), {"type": "message", "id": 1, "payload": bytearray()})
+        self.assertEqual(pc._parse_one(), {"type": "keep-alive"})
+        self.assertEqual(pc._parse_one()["payload"], struct.pack(">I", 9))
+        self.assertIsNone(pc._parse_one())
+
+        # consumed bytes are only moved once, not per message
+        self.assertEqual(pc._recv_head, 18)
+        self.assertEqual(len(pc._recv_buffer), 19)
+
+    def test_parse_one_compacts_buffer(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        block = struct.pack(">IBII", 9 + 16384, 7, 0, 0) + b"x" * 16384
+        pc._recv_buffer = bytearray(block * 3 + b"\x00")
+
+        self.assertEqual(pc._parse_one()["id"], 7)
+        self.assertEqual(pc._recv_head, len(block))
+
+        # past the threshold the consumed prefix is dropped in one go
+        self.assertEqual(pc._parse_one()["id"], 7)
+        self.assertEqual(pc._recv_head, 0)
+        self.assertEqual(pc._recv_buffer, bytearray(block + b"\x00"))
+
+        self.assertEqual(pc._parse_one()["id"], 7)
+
     def test_recv_exact(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         mock_sock = MagicMock()
-        mock_sock.recv.side_effect = [b"ab", b"cd"]
+        chunks = [b"ab", b"cd"]
+
+        def recv_into(view, nbytes):
+            chunk = chunks.pop(0)
+            view[:len(chunk)] = chunk
+            return len(chunk)
+
+        mock_sock.recv_into.side_effect = recv_into
         pc.sock = mock_sock
         result = pc._recv_exact(4, 1.0)
         self.assertEqual(result, b"abcd")
+        self.assertEqual([c.args[1] for c in mock_sock.recv_into.call_args_list], [4, 2])
 
     def test_recv_exact_socket_closed(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         mock_sock = MagicMock()
-        mock_sock.recv.return_value = b''
+        mock_sock.recv_into.return_value = 0
         pc.sock = mock_sock
 
         with self.assertRaises(ConnectionError) as cm:
@@ -255,6 +527,27 @@ class TestPeerConnection(unittest.TestCase):
         pc.ensure_bitmap(10)
         self.assertEqual(len(pc.bitmap), 10)
 
+    def test_mark_have_counts_once(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.ensure_bitmap(10)
+        self.assertTrue(pc.mark_have(3))
+        self.assertFalse(pc.mark_have(3))
+        self.assertTrue(pc.bitmap[3])
+        self.assertEqual(pc.have_count, 1)
+
+    def test_set_bitfield(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.set_bitfield(b"\xF0\x88", 12)
+        self.assertEqual(len(pc.bitmap), 12)
+        self.assertEqual(pc.have_count, 5)
+
+    def test_set_bitfield_short_payload(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.set_bitfield(b"\xFF", 20)
+        self.assertEqual(len(pc.bitmap), 20)
+        self.assertEqual(pc.bitmap.to01(), "1" * 8 + "0" * 12)
+        self.assertEqual(pc.have_count, 8)
+
     def test_record_download_and_upload(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc.record_download(100)
@@ -265,9 +558,10 @@ class TestPeerConnection(unittest.TestCase):
     def test_down_up_speed_bps(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         now = time.time()
-        pc._rates = [(now - 5, 100, 50), (now, 200, 100)]
-        self.assertGreaterEqual(pc.down_speed_bps(), 0)
-        self.assertGreaterEqual(pc.up_speed_bps(), 0)
+        pc._add_sample(now - 5, 100, 50)
+        pc._add_sample(now, 200, 100)
+        self.assertAlmostEqual(pc.down_speed_bps(), 300 / 5, delta=1)
+        self.assertAlmostEqual(pc.up_speed_bps(), 150 / 5, delta=1)
 
     def test_down_speed_bps_empty_rates(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
@@ -293,11 +587,45 @@ class TestPeerConnection(unittest.TestCase):
     def test_trim_samples(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         now = time.time()
-        pc._rates = [(now - 15, 100, 100), (now - 5, 50, 50)]
+        pc._add_sample(now - 15, 100, 100)
+        pc._add_sample(now - 5, 50, 50)
         pc.trim_samples(now)
         self.assertEqual(len(pc._rates), 1)
+        self.assertEqual(pc._sum_down, 50)
+        self.assertEqual(pc._sum_up, 50)
+
+    def test_close_samples_share_a_bucket(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        now = time.time()
+        pc._add_sample(now, 100, 0)
+        pc._add_sample(now + 0.05, 0, 30)
+        pc._add_sample(now + 1, 10, 0)
+        self.assertEqual(list(pc.rates), [(now, 100, 30), (now + 1, 10, 0)])
+        self.assertEqual(pc._sum_down, 110)
+        self.assertEqual(pc._sum_up, 30)
+
+    def test_clear_samples(self):
+        pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
+        pc.record_download(100)
+        pc.record_upload(50)
+        pc.clear_samples()
+        self.assertEqual(len(pc.rates), 0)
+        self.assertEqual(pc._sum_down, 0)
+        self.assertEqual(pc._sum_up, 0)
 
     def test_rates_property(self):
         pc = PeerConnection("127.0.0.1", 6881, self.peer_id)
         pc._rates = [(time.time(), 100, 100)]
         self.assertEqual(pc.rates, pc._rates)
+
+
+class TestPeersFromCompact(unittest.TestCase):
+    def test_parses_entries(self):
+        data = socket.inet_aton("1.2.3.4") + struct.pack(">H", 6881) + socket.inet_aton("255.0.0.9") + b"\xff\xff"
+        peers = peers_from_compact(data, "-PC0001-abcdefghijkl")
+        self.assertEqual([(p.ip, p.port) for p in peers], [("1.2.3.4", 6881), ("255.0.0.9", 65535)])
+        self.assertEqual(peers[0].peer_id, b"-PC0001-abcdefghijkl")
+
+    def test_empty_and_partial(self):
+        self.assertEqual(peers_from_compact(b"", "id"), [])
+        self.assertEqual(peers_from_compact(b"\x01\x02\x03", "id"), [])
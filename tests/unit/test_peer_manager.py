@@ -1,6 +1,7 @@
+import asyncio
 import unittest
 from datetime import datetime, timedelta
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock
 
 from src.peer_manager import PeerManager
 
@@ -21,51 +22,37 @@ class TestPeerManager(unittest.TestCase):
         self.manager.stop_retry_worker()
 
     def test_connect_success(self):
-        self.peer1.connect.return_value = None
-        result = self.manager._connect(self.peer1)
+        self.peer1.connect_async = AsyncMock()
+        result = asyncio.run(self.manager._connect_async(self.peer1, asyncio.Semaphore(1)))
         self.assertEqual(result, self.peer1)
 
     def test_connect_failure(self):
-        self.peer1.connect.side_effect = Exception("fail")
-        result = self.manager._connect(self.peer1)
+        self.peer1.connect_async = AsyncMock(side_effect=Exception("fail"))
+        result = asyncio.run(self.manager._connect_async(self.peer1, asyncio.Semaphore(1)))
         self.assertIsNone(result)
         self.assertIn(self.peer1, self.manager.failed_peers)
         self.assertIn(self.peer1, self.manager.next_retry_time)
 
-    @patch("src.peer_manager.ThreadPoolExecutor")
-    @patch("src.peer_manager.as_completed")
-    def test_connect_all(self, mock_as_completed, mock_pool):
-        future1 = MagicMock()
-        future1.result.return_value = self.peer1
-        future2 = MagicMock()
-        future2.result.return_value = None
-
-        mock_pool.return_value.__enter__.return_value.submit.side_effect = [future1, future2]
-        mock_as_completed.return_value = [future1, future2]
+    def test_connect_all(self):
+        self.peer1.connect_async = AsyncMock()
+        self.peer2.connect_async = AsyncMock(side_effect=ConnectionError("fail"))
 
         self.manager.connect_all()
 
         self.assertEqual(self.manager.peers, [self.peer1])
+        self.peer1.connect_async.assert_awaited_once_with(b"fakehash")
+        self.assertEqual(self.manager.failed_peers, {self.peer2: 1})
+        self.assertIn(self.peer2, self.manager.next_retry_time)
 
-    @patch("src.peer_manager.ThreadPoolExecutor")
-    @patch("src.peer_manager.as_completed")
-    def test_retry_failed_peers_mixed(self, mock_as_completed, mock_pool):
+    def test_retry_failed_peers_mixed(self):
         # one peer fails, one succeeds
-        peer1 = self.peer1
+        peer1 = self.peer3
         peer2 = self.peer2
+        peer1.connect_async = AsyncMock()
+        peer2.connect_async = AsyncMock(side_effect=ConnectionError("fail"))
         self.manager.failed_peers = {peer1: 1, peer2: 1}
-        self.manager.next_retry_time = {
-            peer1: datetime.now() - timedelta(seconds=1),
-            peer2: datetime.now() - timedelta(seconds=1),
-        }
-
-        future1 = MagicMock()
-        future1.result.return_value = peer1
-        future2 = MagicMock()
-        future2.result.return_value = None
-
-        mock_pool.return_value.__enter__.return_value.submit.side_effect = [future1, future2]
-        mock_as_completed.return_value = [future1, future2]
+        self.manager._schedule_retry(peer1, datetime.now() - timedelta(seconds=1))
+        self.manager._schedule_retry(peer2, datetime.now() - timedelta(seconds=1))
 
         self.manager.retry_failed_peers()
 
@@ -78,14 +65,47 @@ class TestPeerManager(unittest.TestCase):
 
     def test_retry_failed_peers_nothing_due(self):
         self.manager.failed_peers = {self.peer1: 1}
-        self.manager.next_retry_time = {self.peer1: datetime.now() + timedelta(seconds=100)}
+        self.manager._schedule_retry(self.peer1, datetime.now() + timedelta(seconds=100))
         original_peers = list(self.manager.peers)
         self.manager.retry_failed_peers()
         self.assertEqual(self.manager.peers, original_peers)
+        self.assertEqual(len(self.manager._retry_heap), 1)
+
+    def test_pop_due_in_time_order(self):
+        now = datetime.now()
+        self.manager._schedule_retry(self.peer2, now - timedelta(seconds=1))
+        self.manager._schedule_retry(self.peer1, now - timedelta(seconds=5))
+        self.manager._schedule_retry(self.peer3, now + timedelta(seconds=5))
+        self.assertEqual(self.manager._pop_due(now), [self.peer1, self.peer2])
+        self.assertEqual(self.manager._pop_due(now), [])
+
+    def test_pop_due_skips_stale_and_exhausted(self):
+        now = datetime.now()
+        self.manager._schedule_retry(self.peer1, now - timedelta(seconds=1))
+        self.manager.next_retry_time.pop(self.peer1)  # connected in the meantime
+
+        self.manager.failed_peers[self.peer2] = self.manager.max_failures
+        self.manager._schedule_retry(self.peer2, now - timedelta(seconds=1))
+
+        self.assertEqual(self.manager._pop_due(now), [])
 
     def test_add_peer(self):
         self.manager.add_peer(self.peer3)
         self.assertIn(self.peer3, self.manager.peers)
+        self.assertEqual(self.manager.version, 1)
+
+    def test_unknown_peers_tracks_add_and_remove(self):
+        manager = PeerManager([MagicMock(ip="10.0.0.1", port=1)], self.torrent_file, self.piece_manager)
+        nat_twin = MagicMock(ip="10.0.0.1", port=2)
+        same = MagicMock(ip="10.0.0.1", port=1)
+
+        self.assertEqual(manager.unknown_peers([same, nat_twin]), [nat_twin])
+
+        manager.add_peer(nat_twin)
+        self.assertEqual(manager.unknown_peers([nat_twin]), [])
+
+        manager.remove_peer(nat_twin)
+        self.assertEqual(manager.unknown_peers([nat_twin]), [nat_twin])
 
     def test_remove_peer_with_bitmap(self):
         self.peer1.bitmap = "bitmap"
@@ -105,6 +125,18 @@ class TestPeerManager(unittest.TestCase):
         self.assertEqual(self.manager.failed_peers, {})
         self.assertEqual(self.manager.next_retry_time, {})
 
+    def test_seconds_until_due(self):
+        now = datetime.now()
+        self.assertEqual(self.manager._seconds_until_due(now, 10), 10)
+
+        self.manager.failed_peers = {self.peer1: 1, self.peer2: 1}
+        self.manager._schedule_retry(self.peer1, now + timedelta(seconds=30))
+        self.assertEqual(self.manager._seconds_until_due(now, 10), 10)
+
+        self.manager._schedule_retry(self.peer2, now + timedelta(seconds=3))
+        self.assertAlmostEqual(self.manager._seconds_until_due(now, 10), 3)
+        self.assertEqual(self.manager._seconds_until_due(now + timedelta(seconds=5), 10), 0)
+
     def test_start_stop_retry_worker(self):
         self.manager.start_retry_worker()
         self.assertTrue(self.manager._retry_thread.is_alive())
@@ -38,6 +38,27 @@ class TestPiece(unittest.TestCase):
             block.is_requested = True
         self.assertIsNone(self.piece.next_block())
 
+    def test_next_block_hands_out_blocks_in_order(self):
+        first = self.piece.next_block()
+        second = self.piece.next_block()
+        self.assertEqual((first.offset, second.offset), (0, 16384))
+        self.assertIsNone(self.piece.next_block())
+
+    def test_requeue_makes_block_available_again(self):
+        first = self.piece.next_block()
+        self.piece.next_block()
+        self.piece.requeue(first)
+        self.assertFalse(first.is_requested)
+        self.assertIs(self.piece.next_block(), first)
+        self.assertIsNone(self.piece.next_block())
+
+    def test_bad_hash_rewinds_next_block(self):
+        self.piece.next_block()
+        self.piece.next_block()
+        self.piece.block_received(0, b'x' * 16384)
+        self.piece.block_received(16384, b'y' * 16384)
+        self.assertEqual(self.piece.next_block().offset, 0)
+
     def test_block_received_successful_completion(self):
         data1 = b'a' * 16384
         data2 = b'b' * 16384
@@ -47,6 +68,47 @@ class TestPiece(unittest.TestCase):
         self.assertTrue(result2)
         self.assertTrue(self.piece.is_complete)
 
+    def test_block_received_out_of_order(self):
+        disk = bytearray(self.length)
+
+        def write(index, offset, data):
+            disk[offset:offset + len(data)] = data
+
+        self.mock_storage.write.side_effect = write
+        self.mock_storage.view.side_effect = lambda offset, length: memoryview(disk)[offset:offset + length]
+
+        self.assertFalse(self.piece.block_received(16384, b'b' * 16384))
+        self.assertEqual(self.piece._hashed_blocks, 0)
+        self.assertTrue(self.piece.block_received(0, b'a' * 16384))
+        self.assertEqual(self.piece._hashed_blocks, 2)
+        self.mock_storage.view.assert_called_once_with(16384, 16384)
+
+    def test_early_blocks_hashed_in_one_view(self):
+        disk = bytearray(4 * 16384)
+        sha1 = hashlib.sha1(b'a' * 16384 + b'b' * 16384 + b'c' * 16384 + b'd' * 16384).digest()
+        storage = Mock()
+        storage.write.side_effect = lambda index, offset, data: disk.__setitem__(slice(offset, offset + len(data)), data)
+        storage.view.side_effect = lambda offset, length: memoryview(disk)[offset:offset + length]
+        piece = Piece(0, sha1, 4 * 16384, 16384, storage, base_offset=0)
+
+        piece.block_received(32768, b'c' * 16384)
+        piece.block_received(16384, b'b' * 16384)
+        piece.block_received(49152, b'd' * 16384)
+        self.assertTrue(piece.block_received(0, b'a' * 16384))
+        storage.view.assert_called_once_with(16384, 49152)
+
+    def test_in_order_blocks_are_not_read_back(self):
+        self.piece.block_received(0, b'a' * 16384)
+        self.piece.block_received(16384, b'b' * 16384)
+        self.mock_storage.view.assert_not_called()
+        self.assertFalse(hasattr(self.piece, "_buffer"))
+
+    def test_bad_hash_then_retry(self):
+        self.piece.block_received(0, b'x' * 16384)
+        self.piece.block_received(16384, b'y' * 16384)
+        self.assertFalse(self.piece.block_received(0, b'a' * 16384))
+        self.assertTrue(self.piece.block_received(16384, b'b' * 16384))
+
     def test_block_received_rejects_wrong_length(self):
         result = self.piece.block_received(0, b'too short')
         self.assertIsNone(result)
@@ -67,7 +129,39 @@ class TestPiece(unittest.TestCase):
         self.assertEqual(self.piece._blocks_received, 0)
         self.assertTrue(all(not b.is_received for b in self.piece.blocks))
 
+    def test_block_received_unaligned_offset(self):
+        result = self.piece.block_received(100, b'a' * self.block_size)
+        self.assertIsNone(result)
+        self.assertEqual(self.piece._blocks_received, 0)
+
+    def test_mark_complete(self):
+        self.piece.mark_complete()
+        self.assertTrue(self.piece.is_complete)
+        self.assertTrue(all(b.is_received for b in self.piece.blocks))
+        self.assertEqual(self.piece._blocks_received, len(self.piece.blocks))
+        self.assertIsNone(self.piece.block_received(0, b'a' * self.block_size))
+
     def test_block_received_no_matching_block(self):
         bad_offset = 99999
         result = self.piece.block_received(bad_offset, b'a' * self.block_size)
         self.assertIsNone(result)
+
+    def test_sha1_looked_up_in_hash_table(self):
+        table = b"x" * 20 + self.sha1 + b"y" * 20
+        piece = Piece(1, table, self.length, self.block_size, self.mock_storage, base_offset=self.length)
+        self.assertEqual(piece.sha1, self.sha1)
+
+        piece.block_received(0, b'a' * self.block_size)
+        self.assertTrue(piece.block_received(self.block_size, b'b' * self.block_size))
+
+    def test_blocks_built_lazily(self):
+        piece = Piece(0, self.sha1, 40000, self.block_size, self.mock_storage, base_offset=0)
+        self.assertIsNone(piece._blocks)
+        self.assertEqual([b.length for b in piece.blocks], [16384, 16384, 7232])
+
+    def test_mark_complete_before_blocks_built(self):
+        piece = Piece(0, self.sha1, self.length, self.block_size, self.mock_storage, base_offset=0)
+        piece.mark_complete()
+        self.assertIsNone(piece.next_block())
+        self.assertIsNone(piece._blocks)
+        self.assertTrue(all(b.is_received for b in piece.blocks))
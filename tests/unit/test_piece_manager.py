@@ -1,4 +1,3 @@
-import time
 import unittest
 from unittest.mock import MagicMock
 
@@ -22,6 +21,12 @@ class TestPieceManager(unittest.TestCase):
         self.assertEqual(_calculate_pieces_lengths(3072, 1024), [1024, 1024, 1024])
         self.assertEqual(_calculate_pieces_lengths(2500, 1000), [1000, 1000, 500])
 
+    def test_piece_hashes(self):
+        self.mock_torrent.pieces = b"a" * 20 + b"b" * 20 + b"c" * 20
+        manager = PieceManager(self.mock_torrent, self.mock_storage)
+        self.assertEqual([p.sha1 for p in manager.pieces], [b"a" * 20, b"b" * 20, b"c" * 20])
+        self.assertEqual([p.length for p in manager.pieces], [1024, 1024, 1024])
+
     def test_add_have_increases_availability(self):
         self.manager.add_have(1)
         self.assertEqual(self.manager.availability[1], 1)
@@ -39,18 +44,49 @@ class TestPieceManager(unittest.TestCase):
         self.manager.peer_disconnect(bitmap)
         self.assertEqual(self.manager.availability[0], 0)
 
+    def test_add_bitmap_twice_and_disconnect(self):
+        self.manager.add_bitmap(bitarray("110"))
+        self.manager.add_bitmap(bitarray("011"))
+        self.assertEqual(self.manager.availability, [1, 2, 1])
+
+        self.manager.peer_disconnect(bitarray("011"))
+        self.assertEqual(self.manager.availability[1], 1)
+        self.assertEqual(self.manager.availability[2], 0)
+
+    def test_add_bitmap_ignores_spare_bits(self):
+        self.manager.add_bitmap(bitarray("10110000"))
+        self.assertEqual(self.manager.availability, [1, 0, 1])
+
     def test_peer_disconnect_all_false(self):
         bitmap = bitarray("000")
         self.manager.peer_disconnect(bitmap)
-        self.assertEqual(self.manager.availability, {})
+        self.assertEqual(self.manager.availability, [0, 0, 0])
 
     def test_on_choke_resets_blocks(self):
         peer = MagicMock()
-        block = MagicMock()
-        self.manager.inflight_by_peer[peer] = [block]
+        block = self.manager.next_request(bitarray("010"), peer)
+        self.assertIs(self.manager.inflight[1, block.offset], peer)
         self.manager.on_choke(peer)
-        block.reset.assert_called_once()
-        self.assertNotIn(peer, self.manager.inflight_by_peer)
+        self.assertFalse(block.is_requested)
+        self.assertIsNone(block.request_time)
+        self.assertEqual(self.manager.inflight, {})
+        self.assertIs(self.manager.next_request(bitarray("010")), block)
+
+    def test_on_choke_leaves_other_peers_blocks(self):
+        peer, other = MagicMock(), MagicMock()
+        mine = self.manager.next_requests_rarest_first(bitarray("100"), 1, peer)[0]
+        theirs = self.manager.next_requests_rarest_first(bitarray("001"), 1, other)[0]
+        self.manager.on_choke(peer)
+        self.assertFalse(mine.is_requested)
+        self.assertTrue(theirs.is_requested)
+        self.assertEqual(self.manager.inflight, {(2, theirs.offset): other})
+
+    def test_block_received_clears_inflight(self):
+        peer = MagicMock()
+        block = self.manager.next_request(bitarray("010"), peer)
+        self.manager.pieces[1].block_received = MagicMock(return_value=False)
+        self.manager.block_received(1, block.offset, b"data")
+        self.assertEqual(self.manager.inflight, {})
 
     def test_next_request_returns_block(self):
         peer_bitmap = bitarray("111")
@@ -88,26 +124,87 @@ class TestPieceManager(unittest.TestCase):
         result = self.manager.next_request(peer_bitmap)
         self.assertIsNone(result)
 
+    def test_next_request_hands_out_every_block_once(self):
+        peer_bitmap = bitarray("101")
+        blocks = []
+        while (block := self.manager.next_request(peer_bitmap)) is not None:
+            blocks.append((block.piece_index, block.offset))
+
+        self.assertEqual(blocks, [(0, 0), (2, 0)])
+        self.assertEqual(self.manager._needs_piece, bitarray("010"))
+
+    def test_next_request_short_peer_bitmap(self):
+        block = self.manager.next_request(bitarray("01"))
+        self.assertEqual(block.piece_index, 1)
+
+    def test_timed_out_block_can_be_requested_again(self):
+        peer_bitmap = bitarray("100")
+        block = self.manager.next_request(peer_bitmap)
+        self.assertIsNone(self.manager.next_request(peer_bitmap))
+
+        block.request_time -= REQUEST_TIMEOUT + 1
+        self.manager.tick()
+
+        again = self.manager.next_request(peer_bitmap)
+        self.assertEqual((again.piece_index, again.offset), (block.piece_index, block.offset))
+
     def test_next_request_rarest_first(self):
         peer_bitmap = bitarray("111")
         for i, piece in enumerate(self.manager.pieces):
             piece.is_complete = False
             piece.next_block = MagicMock(return_value=Block(i, 0, 16))
-            self.manager.availability[i] = 3 - i
+            for _ in range(3 - i):
+                self.manager.add_have(i)
 
         result = self.manager.next_request_rarest_first(peer_bitmap)
         self.assertIsInstance(result, Block)
+        self.assertEqual(result.piece_index, 2)
 
     def test_next_request_rarest_first_all_requested(self):
         peer_bitmap = bitarray("111")
         for i, piece in enumerate(self.manager.pieces):
             piece.is_complete = False
             piece.next_block = MagicMock(return_value=None)
-            self.manager.availability[i] = i
+            for _ in range(i):
+                self.manager.add_have(i)
 
         result = self.manager.next_request_rarest_first(peer_bitmap)
         self.assertIsNone(result)
 
+    def test_next_request_rarest_first_falls_back_to_less_rare(self):
+        self.manager.add_bitmap(bitarray("110"))
+        self.manager.add_have(1)
+        self.manager.pieces[0].is_complete = True
+
+        # piece 2 is rarest but the peer lacks it, piece 0 is done, so piece 1 is next
+        block = self.manager.next_request_rarest_first(bitarray("110"))
+        self.assertEqual(block.piece_index, 1)
+
+    def test_levels_follow_availability(self):
+        self.manager.add_bitmap(bitarray("111"))
+        self.manager.add_have(0)
+        self.manager.peer_disconnect(bitarray("011"))
+
+        self.assertEqual(self.manager.availability, [2, 0, 0])
+        self.assertEqual(self.manager._level_sizes, [2, 0, 1])
+        self.assertEqual(self.manager._levels[0], bitarray("011"))
+        self.assertEqual(self.manager._levels[2], bitarray("100"))
+
+    def test_next_requests_rarest_first_batch(self):
+        self.mock_torrent.total_length = 4 * 16384
+        self.mock_torrent.piece_length = 2 * 16384
+        self.mock_torrent.pieces = b"x" * 40
+        manager = PieceManager(self.mock_torrent, self.mock_storage)
+        manager.add_have(0)
+
+        blocks = manager.next_requests_rarest_first(bitarray("11"), 3)
+
+        # rarer piece 1 is drained first, then piece 0
+        self.assertEqual([(b.piece_index, b.offset) for b in blocks], [(1, 0), (1, 16384), (0, 0)])
+        self.assertEqual(len(manager.next_requests_rarest_first(bitarray("11"), 10)), 1)
+        self.assertEqual(manager.next_requests_rarest_first(bitarray("11"), 10), [])
+        self.assertEqual(manager.next_requests_rarest_first(bitarray("11"), 0), [])
+
     def test_next_request_rarest_first_none(self):
         peer_bitmap = bitarray("000")
         result = self.manager.next_request_rarest_first(peer_bitmap)
@@ -117,7 +214,7 @@ class TestPieceManager(unittest.TestCase):
         peer_bitmap = bitarray("111")
         for i, piece in enumerate(self.manager.pieces):
             piece.is_complete = False
-            self.manager.availability[i] = 1
+            self.manager.add_have(i)
 
             if i == 0:
                 piece.next_block = MagicMock(return_value=None)
@@ -135,32 +232,58 @@ class TestPieceManager(unittest.TestCase):
         result = self.manager.block_received(0, 0, b"data")
         self.assertTrue(result)
         self.assertEqual(self.manager.downloaded_bytes, len(b"data"))
+        self.assertEqual(self.manager.version, 1)
+        self.assertEqual(self.manager._needs_piece, bitarray("011"))
 
     def test_block_received_none(self):
         piece = self.manager.pieces[0]
         piece.block_received = MagicMock(return_value=None)
         result = self.manager.block_received(0, 0, b"data")
         self.assertIsNone(result)
+        self.assertEqual(self.manager.version, 0)
 
     def test_is_finished(self):
-        for piece in self.manager.pieces:
-            piece.is_complete = True
-        self.assertTrue(self.manager.is_finished())
-        self.manager.pieces[1].is_complete = False
+        self.manager.mark_complete(0)
+        self.manager.mark_complete(2)
         self.assertFalse(self.manager.is_finished())
+        self.manager.mark_complete(1)
+        self.assertTrue(self.manager.is_finished())
+
+    def test_mark_complete_counts_once(self):
+        self.manager.mark_complete(1)
+        self.manager.mark_complete(1)
+        self.assertTrue(self.manager.pieces[1].is_complete)
+        self.assertFalse(self.manager._needs_piece[1])
+        self.assertEqual(self.manager._completed_count, 1)
+
+    def test_completed_piece_counts_towards_finished(self):
+        self.manager.mark_complete(0)
+        self.manager.mark_complete(1)
+        self.manager.pieces[2].block_received = MagicMock(return_value=True)
+        self.manager.block_received(2, 0, b"data")
+        self.assertTrue(self.manager.is_finished())
 
     def test_tick_resets_timed_out_requests(self):
-        for piece in self.manager.pieces:
-            piece.is_complete = False
-            block = Block(piece.index, 0, 16)
-            block.is_requested = True
-            block.is_received = False
-            block.request_time = time.time() - (REQUEST_TIMEOUT + 1)  # Force timeout
-            piece.blocks = [block]
+        peer_bitmap = bitarray("111")
+        blocks = [self.manager.next_request(peer_bitmap) for _ in self.manager.pieces]
+        for block in blocks:
+            block.request_time -= REQUEST_TIMEOUT + 1  # Force timeout
 
         self.manager.tick()
 
-        for piece in self.manager.pieces:
-            b = piece.blocks[0]
+        for b in blocks:
             self.assertFalse(b.is_requested)
             self.assertIsNone(b.request_time)
+        self.assertEqual(len(self.manager._requested), 0)
+
+    def test_tick_stops_at_first_live_request(self):
+        peer_bitmap = bitarray("111")
+        old, fresh, received = [self.manager.next_request(peer_bitmap) for _ in range(3)]
+        old.request_time -= REQUEST_TIMEOUT + 1
+        received.is_received = True
+
+        self.manager.tick()
+
+        self.assertFalse(old.is_requested)
+        self.assertTrue(fresh.is_requested)
+        self.assertEqual([b for _, b in self.manager._requested], [fresh, received])
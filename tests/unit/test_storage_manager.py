@@ -1,9 +1,11 @@
+import mmap
 import os
+import socket
 import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
-from src.storage_manager import PieceStorage
+from src.storage_manager import PieceStorage, _SegmentedMap, _copy_range, _preallocate
 
 
 class TestPieceStorage(unittest.TestCase):
@@ -26,12 +28,33 @@ class TestPieceStorage(unittest.TestCase):
         except Exception:
             pass
 
+    def _assert_file_equals(self, path, expected):
+        """checks a file's size and then its whole contents"""
+        self.assertEqual(os.path.getsize(path), len(expected))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), expected)
+
     def test_write_and_read(self):
         data = b"abcd" * 10
         self.storage.write(0, 0, data)
         result = self.storage.read(0, len(data))
         self.assertEqual(result, data)
 
+    def test_write_memoryview_and_view(self):
+        payload = memoryview(b"hdr!" + b"efgh" * 4)[4:]
+        self.storage.write(0, 8, payload)
+
+        view = self.storage.view(8, 16)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, b"efgh" * 4)
+        view.release()
+
+    @unittest.skipUnless(hasattr(os, "posix_fadvise"), "posix_fadvise not available")
+    def test_switch_to_seeding_advises_random_access(self):
+        with patch("src.storage_manager.os.posix_fadvise") as mock_fadvise:
+            self.storage.switch_to_seeding()
+        mock_fadvise.assert_called_once_with(self.storage._fd.fileno(), 0, 1024, os.POSIX_FADV_RANDOM)
+
     def test_switch_to_seeding_single_file(self):
         self.storage.write(0, 0, b"seedtest")
         self.storage.switch_to_seeding()
@@ -52,10 +75,8 @@ class TestPieceStorage(unittest.TestCase):
         f1_path = os.path.join(self.tmp_dir.name, "testfolder", "f1.txt")
         f2_path = os.path.join(self.tmp_dir.name, "testfolder", "f2.txt")
 
-        with open(f1_path, "rb") as f:
-            self.assertEqual(f.read(), b"a" * 512)
-        with open(f2_path, "rb") as f:
-            self.assertEqual(f.read(), b"b" * 512)
+        self._assert_file_equals(f1_path, b"a" * 512)
+        self._assert_file_equals(f2_path, b"b" * 512)
 
     def test_cleanup_handles_exceptions(self):
         self.storage._mmap.close()
@@ -67,8 +88,7 @@ class TestPieceStorage(unittest.TestCase):
         self.assertTrue(os.path.exists(part_path))
 
     def test_part_file_already_exists(self):
-        tmp_dir = tempfile.mkdtemp()
-        try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
             part_path = os.path.join(tmp_dir, "testfile.txt.part")
             with open(part_path, "wb") as f:
                 f.write(b"\x00" * 1024)
@@ -82,12 +102,6 @@ class TestPieceStorage(unittest.TestCase):
             storage = PieceStorage(mock_torrent, tmp_dir)
             self.assertTrue(os.path.exists(part_path))
             storage.cleanup()
-        finally:
-            try:
-                os.remove(part_path)
-                os.rmdir(tmp_dir)
-            except Exception:
-                pass
 
     def test_switch_to_seeding_noop_if_already_read_only(self):
         self.storage._read_only = True
@@ -114,8 +128,7 @@ class TestPieceStorage(unittest.TestCase):
 
         final_path = os.path.join(self.tmp_dir.name, "testfile.txt")
         self.assertTrue(os.path.exists(final_path))
-        with open(final_path, "rb") as f:
-            self.assertEqual(f.read(1024), b"x" * 1024)
+        self._assert_file_equals(final_path, b"x" * 1024)
         self.assertTrue(self.storage._read_only)
 
     def test_scatter_into_files_executes_all_branches(self):
@@ -133,10 +146,57 @@ class TestPieceStorage(unittest.TestCase):
         a_path = os.path.join(self.tmp_dir.name, "multitest", "a.txt")
         b_path = os.path.join(self.tmp_dir.name, "multitest", "b.txt")
 
-        with open(a_path, "rb") as f:
-            self.assertEqual(f.read(), b"x" * 256)
-        with open(b_path, "rb") as f:
-            self.assertEqual(f.read(), b"x" * 768)
+        self._assert_file_equals(a_path, b"x" * 256)
+        self._assert_file_equals(b_path, b"x" * 768)
+
+    @unittest.skipUnless(hasattr(os, "posix_fallocate"), "posix_fallocate not available")
+    def test_part_file_is_preallocated(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch("os.posix_fallocate", wraps=os.posix_fallocate) as fallocate:
+                storage = PieceStorage(self.mock_torrent, tmp_dir)
+            fallocate.assert_called_once()
+            self.assertEqual(fallocate.call_args[0][1:], (0, 1024))
+            storage.cleanup()
+
+    def test_preallocate_falls_back_to_truncate(self):
+        path = os.path.join(self.tmp_dir.name, "prealloc.bin")
+        with patch("os.posix_fallocate", side_effect=OSError, create=True):
+            with open(path, "wb") as f:
+                _preallocate(f.fileno(), 4096)
+        self.assertEqual(os.path.getsize(path), 4096)
+
+    def test_copy_range_falls_back_when_kernel_copy_fails(self):
+        src_path = os.path.join(self.tmp_dir.name, "src.bin")
+        dst_path = os.path.join(self.tmp_dir.name, "dst.bin")
+        with open(src_path, "wb") as f:
+            f.write(bytes(range(256)) * 8)
+
+        with patch("os.copy_file_range", side_effect=OSError), \
+                patch("os.sendfile", side_effect=OSError):
+            with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+                _copy_range(src.fileno(), dst.fileno(), 100, 1000)
+
+        self._assert_file_equals(dst_path, (bytes(range(256)) * 8)[100:1100])
+
+    def test_copy_range_uses_sendfile_without_copy_file_range(self):
+        src_path = os.path.join(self.tmp_dir.name, "src.bin")
+        dst_path = os.path.join(self.tmp_dir.name, "dst.bin")
+        with open(src_path, "wb") as f:
+            f.write(b"a" * 300 + b"b" * 700)
+
+        with patch("os.copy_file_range", side_effect=OSError):
+            with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+                _copy_range(src.fileno(), dst.fileno(), 300, 700)
+
+        self._assert_file_equals(dst_path, b"b" * 700)
+
+    def test_sendfile_sends_from_backing_file(self):
+        self.storage.write(0, 0, b"0123456789" * 10)
+        a, b = socket.socketpair()
+        with a, b:
+            sent = self.storage.sendfile(a.fileno(), 5, 20)
+            self.assertEqual(b.recv(64), b"56789012345678901234"[:sent])
+        self.assertTrue(self.storage.can_sendfile)
 
     def test_cleanup_when_already_closed(self):
         try:
@@ -146,8 +206,7 @@ class TestPieceStorage(unittest.TestCase):
             self.fail(f"cleanup should not raise on double call: {e}")
 
     def test_cleanup_mmap_and_fd_close_exceptions(self):
-        tmp_dir = tempfile.mkdtemp()
-        try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
             mock_torrent = MagicMock()
             mock_torrent.name = "testfile.txt"
             mock_torrent.total_length = 1024
@@ -156,6 +215,7 @@ class TestPieceStorage(unittest.TestCase):
 
             storage = PieceStorage(mock_torrent, tmp_dir)
             storage._mmap.close()
+            storage._fd.close()  # the real handles are released before being swapped for faulty ones
 
             class FaultyMmap:
                 def close(self): raise RuntimeError("mocked mmap close failure")
@@ -170,10 +230,57 @@ class TestPieceStorage(unittest.TestCase):
                 storage.cleanup()
             except Exception as e:
                 self.fail(f"cleanup should not raise: {e}")
-        finally:
+
+
+class TestSegmentedMap(unittest.TestCase):
+    def setUp(self):
+        self.seg = mmap.ALLOCATIONGRANULARITY
+        self.tmp = tempfile.TemporaryFile()
+        self.tmp.truncate(3 * self.seg - 100)
+        self.map = _SegmentedMap(self.tmp.fileno(), 3 * self.seg - 100, mmap.ACCESS_WRITE,
+                                 segment_size=self.seg, max_segments=2)
+
+    def tearDown(self):
+        self.map.close()
+        self.tmp.close()
+
+    def test_write_and_read_across_segments(self):
+        data = bytes(range(256)) * 20
+        start = self.seg - 1000
+        self.map[start:start + len(data)] = data
+        self.assertEqual(self.map[start:start + len(data)], data)
+        self.assertEqual(self.map[0:0], b"")
+
+    def test_evicts_least_recently_used(self):
+        self.map[0:4] = b"abcd"
+        self.map[self.seg:self.seg + 4] = b"efgh"
+        end = len(self.map)
+        self.map[end - 4:end] = b"ijkl"  # maps a third segment, flushes and drops the first
+
+        self.assertEqual(list(self.map._segments), [1, 2])
+        self.assertEqual(self.map[0:4], b"abcd")
+        self.assertEqual(list(self.map._segments), [2, 0])
+
+    def test_wrong_size_assignment(self):
+        with self.assertRaises(IndexError):
+            self.map[0:4] = b"abc"
+
+
+class TestPieceStorageWindowed(unittest.TestCase):
+    def test_large_torrent_uses_segments(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            mock_torrent = MagicMock()
+            mock_torrent.name = "big.bin"
+            mock_torrent.total_length = 3 * mmap.ALLOCATIONGRANULARITY
+            mock_torrent.piece_length = mmap.ALLOCATIONGRANULARITY
+            mock_torrent.is_multifile = False
+
+            with patch("src.storage_manager.MMAP_WINDOW_THRESHOLD", mmap.ALLOCATIONGRANULARITY):
+                storage = PieceStorage(mock_torrent, tmp_dir)
             try:
-                part_path = os.path.join(tmp_dir, "testfile.txt.part")
-                os.remove(part_path)
-                os.rmdir(tmp_dir)
-            except Exception:
-                pass
+                self.assertIsInstance(storage._mmap, _SegmentedMap)
+                storage.write(1, 10, b"x" * 100)
+                self.assertEqual(storage.read(mock_torrent.piece_length + 10, 100), b"x" * 100)
+                self.assertEqual(storage.view(mock_torrent.piece_length + 10, 100), b"x" * 100)
+            finally:
+                storage.cleanup()
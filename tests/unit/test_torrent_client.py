@@ -1,7 +1,11 @@
+import hashlib
+import selectors
+import struct
+import threading
 import unittest
 from unittest.mock import MagicMock, patch
 
-from src.torrent_client import TorrentClient
+from src.torrent_client import TorrentClient, _generate_peer_id
 
 
 class TestTorrentClientInit(unittest.TestCase):
@@ -46,6 +50,188 @@ class TestTorrentClientInit(unittest.TestCase):
         client = TorrentClient("dummy.torrent", peer_id="peer123", download_dir="/path", was_finished=True)
 
         self.assertEqual(client.peer_id, "peer123")
-        for p in pieces:
-            self.assertTrue(p.is_complete)
+        self.assertEqual(mock_manager.mark_complete.call_count, len(pieces))
         self.assertEqual(mock_manager.downloaded_bytes, 2048)
+
+
+class TestHandleMessage(unittest.TestCase):
+    def setUp(self):
+        self.client = TorrentClient.__new__(TorrentClient)
+        self.client.num_pieces = 4
+        self.client.piece_manager = MagicMock()
+        self.client.piece_manager.next_requests_rarest_first.return_value = []
+        self.client.peer_manager = MagicMock(peers=[])
+        self.peer = MagicMock(choked=True)
+
+    def test_piece_block_is_forwarded_without_copy(self):
+        self.client.piece_manager.block_received.return_value = False
+        payload = memoryview(bytearray(struct.pack(">II", 2, 16384) + b"z" * 64))
+
+        self.client._handle_message(self.peer, {"type": "message", "id": 7, "payload": payload})
+
+        index, begin, block = self.client.piece_manager.block_received.call_args[0]
+        self.assertEqual((index, begin), (2, 16384))
+        self.assertIsInstance(block, memoryview)
+        self.assertIs(block.obj, payload.obj)
+        self.assertEqual(bytes(block), b"z" * 64)
+        self.peer.record_download.assert_called_once_with(64)
+
+    def test_choke_returns_blocks(self):
+        self.client._handle_message(self.peer, {"type": "message", "id": 0, "payload": memoryview(b"")})
+        self.assertTrue(self.peer.choked)
+        self.client.piece_manager.on_choke.assert_called_once_with(self.peer)
+
+    def test_unknown_message_id_is_ignored(self):
+        self.peer.choked = False
+        self.peer.bitmap = None
+        self.client._handle_message(self.peer, {"type": "message", "id": 20, "payload": memoryview(b"x")})
+        self.client.piece_manager.block_received.assert_not_called()
+
+    def test_completed_piece_announced_to_active_peers(self):
+        self.client.piece_manager.block_received.return_value = True
+        self.client.piece_manager.is_finished.return_value = False
+        other, idle = MagicMock(active=True), MagicMock(active=False)
+        self.client.peer_manager.peers = [self.peer, other, idle]
+        self.client._flush_peer = MagicMock()
+        payload = memoryview(struct.pack(">II", 1, 0) + b"z" * 16)
+
+        self.client._handle_message(self.peer, {"type": "message", "id": 7, "payload": payload})
+
+        self.peer.send_have.assert_called_once_with(1)
+        other.send_have.assert_called_once_with(1)
+        idle.send_have.assert_not_called()
+        self.client._flush_peer.assert_called_once_with(other)
+
+    def test_request_served_from_piece_offset(self):
+        self.peer.remote_choked = False
+        self.client.piece_manager.pieces = [MagicMock(is_complete=True, base_offset=i * 32, length=32)
+                                            for i in range(4)]
+        self.client.piece_storage = MagicMock()
+
+        self.client._handle_message(self.peer, {"type": "message", "id": 6,
+                                                "payload": memoryview(struct.pack(">III", 2, 8, 8))})
+        self.client._handle_message(self.peer, {"type": "message", "id": 6,
+                                                "payload": memoryview(struct.pack(">III", 2, 30, 8))})
+
+        self.peer.send_piece_from.assert_called_once_with(2, 8, self.client.piece_storage, 72, 8)
+        self.peer.record_upload.assert_not_called()  # counted once, by the peer connection
+
+    def test_have_updates_availability_once(self):
+        self.peer.mark_have.side_effect = [True, False]
+        msg = {"type": "message", "id": 4, "payload": memoryview(struct.pack(">I", 3))}
+
+        self.client._handle_message(self.peer, msg)
+        self.client._handle_message(self.peer, msg)
+
+        self.client.piece_manager.add_have.assert_called_once_with(3)
+
+
+class TestEventLoop(unittest.TestCase):
+    def setUp(self):
+        self.client = TorrentClient.__new__(TorrentClient)
+        self.client.paused = False
+        self.client._paused_cond = threading.Condition()
+        self.client.piece_manager = MagicMock()
+        self.client.select = MagicMock()
+        self.client.select.get_map.return_value = {}
+
+    @patch("src.torrent_client.sleep")
+    @patch("src.torrent_client.time.monotonic")
+    def test_tick_runs_once_per_interval(self, mock_monotonic, mock_sleep):
+        self.client.piece_manager.is_finished.side_effect = [False, False, False, True]
+        mock_monotonic.side_effect = [100.0, 100.5, 101.0]
+
+        self.client._event_loop()
+
+        self.assertEqual(self.client.piece_manager.tick.call_count, 2)
+
+    def test_ready_peer_is_flushed_once(self):
+        self.client.piece_manager.is_finished.side_effect = [False, True]
+        peer = MagicMock(active=True)
+        peer.recv_messages.return_value = []
+        self.client.select.get_map.return_value = {1: None}
+        self.client.select.select.return_value = [
+            (MagicMock(data=peer), selectors.EVENT_READ | selectors.EVENT_WRITE)]
+
+        self.client._event_loop()
+
+        peer.recv_messages.assert_called_once()
+        peer.flush.assert_called_once()
+
+
+class TestFlushPeer(unittest.TestCase):
+    def setUp(self):
+        self.client = TorrentClient.__new__(TorrentClient)
+        self.client.select = MagicMock()
+        self.peer = MagicMock()
+
+    def test_flushes_and_watches_write_while_output_left(self):
+        self.peer.wants_write = True
+        self.client.select.get_key.return_value.events = selectors.EVENT_READ
+
+        self.client._flush_peer(self.peer)
+
+        self.peer.flush.assert_called_once()
+        self.client.select.modify.assert_called_once_with(
+            self.peer.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=self.peer)
+
+    def test_unregistered_socket_is_ignored(self):
+        self.peer.wants_write = False
+        self.client.select.get_key.side_effect = KeyError
+
+        self.client._flush_peer(self.peer)
+
+        self.peer.flush.assert_called_once()
+        self.client.select.modify.assert_not_called()
+
+
+class TestVerifyExisting(unittest.TestCase):
+    def setUp(self):
+        self.client = TorrentClient.__new__(TorrentClient)
+        self.client.torrent_file = MagicMock()
+        self.disk = b"a" * 16 + b"b" * 16 + b"c" * 8
+        self.client.piece_storage = MagicMock(concurrent_reads=True)
+        self.client.piece_storage.view.side_effect = lambda offset, length: memoryview(self.disk)[offset:offset + length]
+
+        self.pieces = [
+            MagicMock(index=0, base_offset=0, length=16, sha1=hashlib.sha1(b"a" * 16).digest()),
+            MagicMock(index=1, base_offset=16, length=16, sha1=hashlib.sha1(b"x" * 16).digest()),
+            MagicMock(index=2, base_offset=32, length=8, sha1=hashlib.sha1(b"c" * 8).digest()),
+        ]
+        self.client.piece_manager = MagicMock(pieces=self.pieces, downloaded_bytes=0)
+        self.client.piece_manager.is_finished.return_value = False
+
+    def test_marks_matching_pieces(self):
+        self.client._verify_existing()
+
+        marked = [c.args[0] for c in self.client.piece_manager.mark_complete.call_args_list]
+        self.assertEqual(marked, [0, 2])
+        self.assertEqual(self.client.piece_manager.downloaded_bytes, 24)
+        self.client.piece_storage.switch_to_seeding.assert_not_called()
+
+    def test_switches_to_seeding_when_all_present(self):
+        self.pieces[1].sha1 = hashlib.sha1(b"b" * 16).digest()
+        self.client.piece_manager.is_finished.return_value = True
+
+        self.client._verify_existing()
+
+        self.assertEqual(self.client.piece_manager.mark_complete.call_count, 3)
+        self.client.piece_storage.switch_to_seeding.assert_called_once()
+
+
+class TestGenerateBitfield(unittest.TestCase):
+    def test_bits_follow_piece_completion(self):
+        client = TorrentClient.__new__(TorrentClient)
+        flags = [True, False, True, True, False, False, False, False, True, False]
+        client.piece_manager = MagicMock(pieces=[MagicMock(index=i, is_complete=f) for i, f in enumerate(flags)])
+
+        self.assertEqual(client._generate_bitfield(), b"\xb0\x80")
+
+
+class TestGeneratePeerId(unittest.TestCase):
+    def test_format(self):
+        peer_id = _generate_peer_id()
+        self.assertEqual(len(peer_id), 20)
+        self.assertTrue(peer_id.startswith("-PC0001-"))
+        int(peer_id[8:], 16)
+        self.assertNotEqual(peer_id, _generate_peer_id())
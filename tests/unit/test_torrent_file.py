@@ -2,67 +2,85 @@ import hashlib
 import unittest
 from unittest.mock import patch, mock_open
 
+import bencodepy
+
 from src.torrent_file import TorrentFile
 
+SINGLE_FILE_META = {
+    'announce': 'http://tracker.example.com/announce',
+    'info': {
+        'name': 'testfile.txt',
+        'length': 12345,
+        'piece length': 512,
+        'pieces': b'12345678901234567890'
+    }
+}
+MULTI_FILE_META = {
+    'announce': 'http://tracker.example.com/announce',
+    'info': {
+        'name': 'testfolder',
+        'piece length': 512,
+        'pieces': b'12345678901234567890',
+        'files': [
+            {'length': 1000, 'path': ['file1.txt']},
+            {'length': 2000, 'path': ['file2.txt']}
+        ]
+    },
+    'announce-list': [['http://tracker.example.com/announce']]
+}
+
+
+def _parse(metadata):
+    """parses a TorrentFile whose file contents and decoded form are the given metadata"""
+    tf = TorrentFile("dummy.torrent")
+    with patch("src.torrent_file.Bencode.bencode_decode", return_value=metadata), \
+            patch("builtins.open", mock_open(read_data=bencodepy.encode(metadata))):
+        tf.parse()
+    return tf
+
 
 class TestTorrentFile(unittest.TestCase):
 
-    def setUp(self):
-        self.single_file_dict = {
-            'announce': 'http://tracker.example.com/announce',
-            'info': {
-                'name': 'testfile.txt',
-                'length': 12345,
-                'piece length': 512,
-                'pieces': b'12345678901234567890'
-            }
-        }
-        self.multi_file_dict = {
-            'announce': 'http://tracker.example.com/announce',
-            'info': {
-                'name': 'testfolder',
-                'piece length': 512,
-                'pieces': b'12345678901234567890',
-                'files': [
-                    {'length': 1000, 'path': ['file1.txt']},
-                    {'length': 2000, 'path': ['file2.txt']}
-                ]
-            },
-            'announce-list': [['http://tracker.example.com/announce']]
-        }
-
-    @patch("builtins.open", new_callable=mock_open, read_data=b'fake_bencoded_data')
-    @patch("src.torrent_file.Bencode.bencode_decode")
-    @patch("src.torrent_file.bencodepy.encode")
-    def test_parse_single_file(self, mock_encode, mock_decode, mock_file):
-        mock_decode.return_value = self.single_file_dict
-        mock_encode.return_value = b'encoded_info'
+    @classmethod
+    def setUpClass(cls):
+        # parsed once, the tests below only read them
+        cls.tf_single = _parse(SINGLE_FILE_META)
+        cls.tf_multi = _parse(MULTI_FILE_META)
 
-        tf = TorrentFile("dummy.torrent")
-        tf.parse()
+    def test_parse_single_file(self):
+        tf = self.tf_single
 
         self.assertEqual(tf.announce, 'http://tracker.example.com/announce')
         self.assertEqual(tf.name, 'testfile.txt')
         self.assertEqual(tf.total_length, 12345)
         self.assertFalse(tf.is_multifile)
         self.assertEqual(tf.files[0]["path"], ['testfile.txt'])
-        self.assertEqual(tf.info_hash, hashlib.sha1(b'encoded_info', usedforsecurity=False).digest())
+        self.assertEqual(tf.info_hash, hashlib.sha1(bencodepy.encode(SINGLE_FILE_META['info'])).digest())
 
-    @patch("builtins.open", new_callable=mock_open, read_data=b'fake_bencoded_data')
-    @patch("src.torrent_file.Bencode.bencode_decode")
-    @patch("src.torrent_file.bencodepy.encode")
-    def test_parse_multi_file(self, mock_encode, mock_decode, mock_file):
-        mock_decode.return_value = self.multi_file_dict
-        mock_encode.return_value = b'encoded_info'
-
-        tf = TorrentFile("dummy.torrent")
-        tf.parse()
+    def test_parse_multi_file(self):
+        tf = self.tf_multi
 
         self.assertTrue(tf.is_multifile)
         self.assertEqual(len(tf.files), 2)
         self.assertEqual(tf.total_length, 3000)
         self.assertEqual(tf.announce_list, [['http://tracker.example.com/announce']])
 
+    def test_parse_optional_fields(self):
+        metadata = dict(SINGLE_FILE_META)
+        metadata['comment'] = b'\xffhello'
+        metadata['creation date'] = 1700000000
+
+        tf = _parse(metadata)
+
+        self.assertEqual(tf.comment, 'hello')
+        self.assertEqual(tf.creation_date, 1700000000)
+
+    def test_parse_optional_fields_missing(self):
+        tf = self.tf_single
+
+        self.assertIsNone(tf.comment)
+        self.assertIsNone(tf.creation_date)
+
     def test_file_layout(self):
         tf = TorrentFile("dummy.torrent")
         tf.files = [
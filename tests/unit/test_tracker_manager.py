@@ -1,6 +1,6 @@
-import concurrent.futures
+import contextlib
 import unittest
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
 from src.peer_connection import PeerConnection
@@ -8,12 +8,30 @@ from src.torrent_file import TorrentFile
 from src.tracker_manager import TrackerManager
 
 
+def _finished(result=None, exception=None):
+    """an already completed future holding result, or exception if given"""
+    future = Future()
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+    return future
+
+
+@contextlib.contextmanager
+def _pool_returning(future):
+    """patches the announce thread pool so every submitted call resolves to future"""
+    with patch("src.tracker_manager.ThreadPoolExecutor") as mock_pool:
+        mock_pool.return_value.__enter__.return_value.submit.return_value = future
+        yield mock_pool
+
+
 class TestTrackerManager(unittest.TestCase):
     def setUp(self):
         self.torrent_file = MagicMock(spec=TorrentFile)
         self.torrent_file.announce = "http://tracker.example.com/announce"
         self.torrent_file.announce_list = [["http://tracker2.com/announce"], ["udp://tracker3.com:6969"]]
-        self.torrent_file.pieces = [b'x'] * 3
+        self.torrent_file.pieces = b'x' * 60  # 3 piece hashes
         self.peer_id = "-PC0001-testid"
 
     @patch("src.tracker_manager.UDPTrackerClient")
@@ -38,78 +56,84 @@ class TestTrackerManager(unittest.TestCase):
             mgr = TrackerManager(self.torrent_file, self.peer_id)
             self.assertEqual(len(mgr.trackers), 1)  # only the original HTTP one
 
-    @patch("src.tracker_manager.ThreadPoolExecutor")
-    def test_get_all_peers_success(self, mock_pool):
-        mock_tracker = MagicMock()
-        mock_tracker.client.get_peers.return_value = (
-            [self._fake_peer(True, ip_suffix="1"), self._fake_peer(False, ip_suffix="2")],
-            900
-        )
-        mock_tracker.client.tracker_url = "http://example.com"
+    @patch("src.tracker_manager.UDPTrackerClient")
+    @patch("src.tracker_manager.HTTPTrackerClient")
+    def test_update_next_announce_tracks_minimum(self, mock_http_client, mock_udp_client):
+        mgr = TrackerManager(self.torrent_file, self.peer_id)
+        self.assertEqual(mgr.min_next_announce, min(t.next_announce for t in mgr.trackers))
 
-        manager = TrackerManager(self.torrent_file, self.peer_id)
-        manager.trackers = [mock_tracker]
+        mgr.update_next_announce(mgr.trackers[1], 10.0)
+        self.assertEqual(mgr.trackers[1].next_announce, 10.0)
+        self.assertEqual(mgr.min_next_announce, 10.0)
 
-        future = concurrent.futures.Future()
-        future.set_result(mock_tracker.client.get_peers("started"))
+        mgr.update_next_announce(mgr.trackers[1], mgr.trackers[0].next_announce + 100)
+        self.assertEqual(mgr.min_next_announce, min(t.next_announce for t in mgr.trackers))
 
-        executor = MagicMock()
-        executor.submit.return_value = future
-        mock_pool.return_value.__enter__.return_value = executor
+    def test_get_all_peers_success(self):
+        mock_tracker = MagicMock()
+        mock_tracker.client.tracker_url = "http://example.com"
+        manager = self._manager_with([mock_tracker])
 
-        peers, interval = manager.get_all_peers("started")
+        with _pool_returning(_finished(
+                result=([self._fake_peer(True, ip_suffix="1"), self._fake_peer(False, ip_suffix="2")], 900))):
+            peers, interval = manager.get_all_peers("started")
 
         self.assertEqual(interval, 900)
         self.assertEqual(len(peers), 2)
+        self.assertEqual(manager.trackers[0].last_seeds, 1)
+        self.assertEqual(manager.trackers[0].last_peers, 1)
 
-    @patch("src.tracker_manager.ThreadPoolExecutor")
-    def test_get_all_peers_with_exception(self, mock_pool):
+    def test_get_all_peers_with_exception(self):
         mock_tracker = MagicMock()
         mock_tracker.client.tracker_url = "http://badtracker.com"
-        mock_tracker.client.get_peers.side_effect = Exception("failed")
-
-        manager = TrackerManager(self.torrent_file, self.peer_id)
-        manager.trackers = [mock_tracker]
-
-        future = concurrent.futures.Future()
-        future.set_exception(Exception("failed"))
+        manager = self._manager_with([mock_tracker])
 
-        executor = MagicMock()
-        executor.submit.return_value = future
-        mock_pool.return_value.__enter__.return_value = executor
-
-        peers, interval = manager.get_all_peers("started")
+        with _pool_returning(_finished(exception=Exception("failed"))):
+            peers, interval = manager.get_all_peers("started")
 
         self.assertEqual(interval, 1800)
         self.assertEqual(len(peers), 0)
         self.assertEqual(manager.trackers[0].last_status, "error")
 
-    @patch("src.tracker_manager.UDPTrackerClient")
-    @patch("src.tracker_manager.HTTPTrackerClient")
-    def test_get_all_peers_duplicate_peer_skipped(self, mock_http_client, mock_udp_client):
+    def test_get_all_peers_duplicate_peer_skipped(self):
         mock_tracker = MagicMock()
-        peer = self._fake_peer(True, ip_suffix="1", port=6881)
         mock_tracker.client.tracker_url = "http://example.com"
-        mock_tracker.client.get_peers.return_value = ([peer, peer], 900)
-
-        manager = TrackerManager(self.torrent_file, self.peer_id)
-        manager.trackers = [mock_tracker]
+        manager = self._manager_with([mock_tracker])
+        peer = self._fake_peer(True, ip_suffix="1", port=6881)
 
-        future = Future()
-        future.set_result(([peer, peer], 900))
+        with _pool_returning(_finished(result=([peer, peer], 900))):
+            peers, interval = manager.get_all_peers("started")
 
-        with patch("src.tracker_manager.ThreadPoolExecutor") as mock_executor:
-            mock_executor.return_value.__enter__.return_value.submit.return_value = future
-            mock_executor.return_value.__enter__.return_value.__iter__.return_value = iter([future])
+        self.assertEqual(len(peers), 1)
+        self.assertEqual(interval, 900)
 
-            peers, interval = manager.get_all_peers("started")
-            self.assertEqual(len(peers), 1)
-            self.assertEqual(interval, 900)
+    def _manager_with(self, trackers):
+        """a TrackerManager over the given trackers, without building tracker clients in __init__"""
+        manager = TrackerManager.__new__(TrackerManager)
+        manager.torrent_file = self.torrent_file
+        manager.version = 0
+        manager.trackers = trackers
+        manager.min_next_announce = None
+        return manager
 
     def _fake_peer(self, complete, ip_suffix="1", port=6881):
         peer = MagicMock(spec=PeerConnection)
         peer.ip = f"127.0.0.{ip_suffix}"
         peer.port = port
         peer.bitmap = MagicMock()
-        peer.bitmap.count.return_value = 3 if complete else 1
+        peer.have_count = 3 if complete else 1
         return peer
+
+    def test_get_all_peers_announces_to_all_trackers_at_once(self):
+        manager = self._manager_with([MagicMock() for _ in range(12)])
+        for tracker in manager.trackers:
+            tracker.client.get_peers.return_value = ([], 900)
+
+        with patch("src.tracker_manager.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as mock_executor:
+            manager.get_all_peers("started")
+
+        mock_executor.assert_called_once_with(max_workers=12)
+
+    def test_get_all_peers_without_trackers(self):
+        manager = self._manager_with([])
+        self.assertEqual(manager.get_all_peers("started"), ([], 1800))
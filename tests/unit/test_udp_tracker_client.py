@@ -13,6 +13,18 @@ class DummyTorrentFile:
         self.info_hash = b"\x01" * 20
 
 
+def _compact(ip, port):
+    return socket.inet_aton(ip) + struct.pack(">H", port)
+
+
+def _connect_response(transaction_id, connection_id):
+    return struct.pack(">LLQ", 0, transaction_id, connection_id)
+
+
+def _announce_response(transaction_id, interval, peers=b"", leechers=0, seeders=0):
+    return struct.pack(">LLLLL", 1, transaction_id, interval, leechers, seeders) + peers
+
+
 class TestUDPTrackerClient(unittest.TestCase):
     def setUp(self):
         self.peer_id = "-PC0001-abcdefghijklm"
@@ -25,20 +37,12 @@ class TestUDPTrackerClient(unittest.TestCase):
         mock_sock = MagicMock()
         mock_socket_class.return_value = mock_sock
 
-        # mock connection_id response
         transaction_id = self.client.transaction_id
-        connection_id = 0x1122334455667788
-        conn_resp = struct.pack(">LLQ", 0, transaction_id, connection_id)
-        mock_sock.recv.side_effect = [conn_resp]
+        mock_sock.recv.side_effect = [_connect_response(transaction_id, 0x1122334455667788)]
 
-        # mock announce response
         interval = 1800
-        num_leechers = 10
-        num_seeders = 5
-        peer_ip = socket.inet_aton("127.0.0.1")
-        peer_port = struct.pack(">H", 6881)
-        peer_data = peer_ip + peer_port
-        announce_resp = struct.pack(">LLLLL", 1, transaction_id, interval, num_leechers, num_seeders) + peer_data
+        announce_resp = _announce_response(transaction_id, interval, _compact("127.0.0.1", 6881),
+                                           leechers=10, seeders=5)
         mock_sock.recvfrom.return_value = (announce_resp, ("tracker.example.com", 80))
 
         peers, returned_interval = self.client.get_peers("started")
@@ -49,6 +53,37 @@ class TestUDPTrackerClient(unittest.TestCase):
         self.assertEqual(peers[0].ip, "127.0.0.1")
         self.assertEqual(peers[0].port, 6881)
 
+    @patch("socket.socket")
+    def test_get_peers_ignores_trailing_partial_entry(self, mock_socket_class):
+        mock_sock = MagicMock()
+        mock_socket_class.return_value = mock_sock
+        transaction_id = self.client.transaction_id
+        mock_sock.recv.side_effect = [_connect_response(transaction_id, 1)]
+
+        peer_data = _compact("10.0.0.1", 1000) + _compact("10.0.0.2", 2000) + b"\x0a\x00"
+        announce_resp = _announce_response(transaction_id, 900, peer_data)
+        mock_sock.recvfrom.return_value = (announce_resp, ("tracker.example.com", 80))
+
+        peers, _ = self.client.get_peers(None)
+
+        self.assertEqual([(p.ip, p.port) for p in peers], [("10.0.0.1", 1000), ("10.0.0.2", 2000)])
+
+    @patch("socket.socket")
+    def test_reannounce_reuses_connection_id(self, mock_socket_class):
+        mock_sock = MagicMock()
+        mock_socket_class.return_value = mock_sock
+        transaction_id = self.client.transaction_id
+        mock_sock.recv.side_effect = [_connect_response(transaction_id, 42)]
+        announce_resp = _announce_response(transaction_id, 900)
+        mock_sock.recvfrom.return_value = (announce_resp, ("tracker.example.com", 80))
+
+        self.client.get_peers("started")
+        self.client.get_peers(None)
+
+        mock_sock.recv.assert_called_once()  # second announce skipped the connect round trip
+        self.assertEqual(struct.unpack_from(">Q", mock_sock.sendto.call_args[0][0])[0], 42)
+        self.assertEqual(mock_sock.close.call_count, 2)
+
     def test_invalid_tracker_url(self):
         with self.assertRaises(ValueError):
             bad_client = UDPTrackerClient(self.torrent_file, self.peer_id, "http://tracker.example.com:80")
@@ -60,8 +95,7 @@ class TestUDPTrackerClient(unittest.TestCase):
         mock_socket_class.return_value = mock_sock
 
         wrong_tid = self.client.transaction_id + 1
-        conn_resp = struct.pack(">LLQ", 0, wrong_tid, 0x12345678)
-        mock_sock.recv.side_effect = [conn_resp]
+        mock_sock.recv.side_effect = [_connect_response(wrong_tid, 0x12345678)]
 
         with self.assertRaises(Exception) as cm:
             self.client.get_peers("started")